@@ -1,12 +1,17 @@
-import hashlib
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from jose import JWTError, jwt
-from passlib.context import CryptContext
+from functools import lru_cache
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
+from . import hashing
 from .models import User
-from .database import SessionLocal
+from .database import SessionLocal, run_db
 
 # -------------------------
 # CONFIG
@@ -15,14 +20,32 @@ SECRET_KEY = "mysecretkey"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30000
 
+# cache (username, role) ของผู้ใช้ที่ยืนยันแล้ว ลด query userdata ทุก request
+# 0 = ปิด cache
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", "60"))
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "4096"))
+# 1 = endpoint อ่านอย่างเดียวเชื่อ role ใน token (ที่ลงลายเซ็นแล้ว) ไม่ต้องดู DB
+AUTH_TRUST_TOKEN_ROLE = os.getenv("AUTH_TRUST_TOKEN_ROLE", "0") == "1"
+
 # ✅ ใช้ argon2-only
-pwd_context = CryptContext(
-    schemes=["argon2"],
-    default="argon2",
-    deprecated="auto"
-)
+# เปลี่ยนพารามิเตอร์แล้ว hash เดิมจะถูก rehash อัตโนมัติตอน login
+# สร้างตอนใช้ครั้งแรก (passlib + argon2 ไม่ต้องโหลดตอน cold start ของ request ที่ไม่ hash)
+@lru_cache(maxsize=None)
+def get_pwd_context():
+    from passlib.context import CryptContext
+
+    return CryptContext(
+        schemes=["argon2"],
+        default="argon2",
+        deprecated="auto",
+        argon2__time_cost=int(os.getenv("ARGON2_TIME_COST", "3")),
+        argon2__memory_cost=int(os.getenv("ARGON2_MEMORY_COST", "65536")),
+        argon2__parallelism=int(os.getenv("ARGON2_PARALLELISM", "4")),
+    )
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
+# ไม่มี header Authorization → None (endpoint รับ token ทางอื่นได้ เช่น SSE ผ่าน EventSource)
+oauth2_scheme_optional = OAuth2PasswordBearer(tokenUrl="login", auto_error=False)
 
 # -------------------------
 # DATABASE SESSION
@@ -37,13 +60,39 @@ def get_db():
 # -------------------------
 # PASSWORD FUNCTIONS
 # -------------------------
+def _hash_pool_busy():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many login requests, retry shortly",
+        headers={"Retry-After": str(hashing.HASH_RETRY_AFTER_SECONDS)},
+    )
+
+def _on_hash_pool(fn, *args):
+    # hash บน pool แยก (api/hashing.py) ไม่กิน thread ของ request อื่น
+    try:
+        return hashing.pool.run(fn, *args)
+    except hashing.HashPoolBusy:
+        raise _hash_pool_busy()
+
+async def _on_hash_pool_async(fn, *args):
+    # รอผลบน event loop: ระหว่าง hash ไม่จอง thread ของ threadpool ไว้เลย
+    try:
+        future = hashing.pool.submit(fn, *args)
+    except hashing.HashPoolBusy:
+        raise _hash_pool_busy()
+    return await asyncio.wrap_future(future)
+
 def hash_password(password: str) -> str:
     """Hash plain password ด้วย Argon2"""
-    return pwd_context.hash(password)
+    return _on_hash_pool(get_pwd_context().hash, password)
 
 def verify_password(password: str, hashed: str) -> bool:
     """Verify plain password กับ Argon2 hash"""
-    return pwd_context.verify(password, hashed)
+    return _on_hash_pool(get_pwd_context().verify, password, hashed)
+
+def verify_and_update(password: str, hashed: str):
+    """(ถูกต้องไหม, hash ใหม่ถ้าพารามิเตอร์ Argon2 เปลี่ยน ไม่งั้น None)"""
+    return _on_hash_pool(get_pwd_context().verify_and_update, password, hashed)
 
 # -------------------------
 # AUTH FUNCTIONS
@@ -52,31 +101,175 @@ def authenticate_user(db: Session, username: str, password: str):
     user = db.query(User).filter(User.username == username).first()
     if not user:
         return None
-    if not verify_password(password, user.hashed_password):
+    ok, new_hash = verify_and_update(password, user.hashed_password)
+    if not ok:
         return None
+    if new_hash:
+        # rehash ด้วยพารามิเตอร์ปัจจุบัน (ผู้เรียก commit)
+        user.hashed_password = new_hash
     return user
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
+    from jose import jwt
+
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(
+# -------------------------
+# PRINCIPAL CACHE
+# -------------------------
+@dataclass(frozen=True)
+class Principal:
+    """ผู้ใช้ที่ยืนยันตัวตนแล้ว (ฟิลด์ที่ endpoint ใช้จริง)"""
+    username: str
+    role: str
+
+
+class PrincipalCache:
+    """TTL + LRU ต่อ process, key = sub ของ token"""
+
+    def __init__(self, ttl: float = AUTH_CACHE_TTL_SECONDS, maxsize: int = AUTH_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, username: str):
+        with self._lock:
+            entry = self._data.get(username)
+            if entry is None:
+                return None
+            expires, principal = entry
+            if expires < time.monotonic():
+                del self._data[username]
+                return None
+            self._data.move_to_end(username)
+            return principal
+
+    def put(self, principal: Principal):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._data[principal.username] = (time.monotonic() + self.ttl, principal)
+            self._data.move_to_end(principal.username)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, username: str = None):
+        with self._lock:
+            if username is None:
+                self._data.clear()
+            else:
+                self._data.pop(username, None)
+
+
+principal_cache = PrincipalCache()
+
+
+def invalidate_principal(username: str = None):
+    """เรียกหลังเปลี่ยนรหัสผ่าน / role / สร้าง-ลบ user (None = ล้างทั้งหมด)"""
+    principal_cache.invalidate(username)
+
+
+def _credentials_exception():
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Invalid credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+
+def _decode_token(token: str) -> dict:
+    from jose import JWTError, jwt
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
     except JWTError:
-        raise credentials_exception
+        raise _credentials_exception()
+    if payload.get("sub") is None:
+        raise _credentials_exception()
+    return payload
 
-    user = db.query(User).filter(User.username == username).first()
-    if user is None:
-        raise credentials_exception
-    return user
+
+def _load_principal(db: Session, username: str):
+    row = db.query(User.username, User.role).filter(User.username == username).first()
+    return Principal(username=row.username, role=row.role) if row else None
+
+
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> Principal:
+    username = _decode_token(token)["sub"]
+
+    principal = principal_cache.get(username)
+    if principal is not None:
+        return principal
+
+    principal = _load_principal(db, username)
+    if principal is None:
+        raise _credentials_exception()
+    principal_cache.put(principal)
+    return principal
+
+
+def get_read_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> Principal:
+    """
+    สำหรับ endpoint อ่านอย่างเดียว
+    AUTH_TRUST_TOKEN_ROLE=1 → ใช้ sub/role ใน token ตรงๆ (role อาจค้างจนกว่า token หมดอายุ)
+    """
+    if AUTH_TRUST_TOKEN_ROLE:
+        payload = _decode_token(token)
+        if payload.get("role"):
+            return Principal(username=payload["sub"], role=payload["role"])
+    return get_current_user(token=token, db=db)
+
+
+# -------------------------
+# ASYNC (endpoint แบบ async def ใช้คู่กับ database.run_db)
+# -------------------------
+async def get_current_user_async(token: str = Depends(oauth2_scheme)) -> Principal:
+    username = _decode_token(token)["sub"]
+
+    principal = principal_cache.get(username)
+    if principal is not None:
+        return principal
+
+    principal = await run_db(_load_principal, username)
+    if principal is None:
+        raise _credentials_exception()
+    principal_cache.put(principal)
+    return principal
+
+
+def _load_login(db: Session, username: str):
+    return (
+        db.query(User.username, User.role, User.hashed_password)
+        .filter(User.username == username)
+        .first()
+    )
+
+
+async def authenticate_user_async(username: str, password: str):
+    """
+    authenticate_user สำหรับ endpoint แบบ async
+    คืน (Principal, hash ใหม่ถ้าต้อง rehash ไม่งั้น None) หรือ (None, None) ถ้าไม่ผ่าน
+    ผู้เรียกเขียน hash ใหม่กลับเอง
+    """
+    row = await run_db(_load_login, username)
+    if row is None:
+        return None, None
+    ok, new_hash = await _on_hash_pool_async(
+        get_pwd_context().verify_and_update, password, row.hashed_password
+    )
+    if not ok:
+        return None, None
+    return Principal(username=row.username, role=row.role), new_hash
+
+
+async def get_read_user_async(token: str = Depends(oauth2_scheme)) -> Principal:
+    """get_read_user สำหรับ endpoint แบบ async"""
+    if AUTH_TRUST_TOKEN_ROLE:
+        payload = _decode_token(token)
+        if payload.get("role"):
+            return Principal(username=payload["sub"], role=payload["role"])
+    return await get_current_user_async(token=token)
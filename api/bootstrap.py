@@ -0,0 +1,265 @@
+"""
+สร้าง / อัปเดต schema ของฐานข้อมูล (แทน create_all ตอน import)
+
+    python -m api.bootstrap migrate   # apply migration ที่ยังไม่ได้รัน
+    python -m api.bootstrap status    # ดู version ปัจจุบัน
+
+- model ที่ map กับ view (info={"is_view": True}) ไม่ถูกสร้างเป็น table
+- migration ที่สร้าง index บน table ที่มีอยู่แล้วใช้ CREATE INDEX CONCURRENTLY
+  รันนอก transaction (autocommit) จึงไม่ block การเขียนระหว่าง build
+- app ไม่แตะ DB ตอน start: check_schema_version() เช็ค version ครั้งเดียวต่อ process
+  ตอนมี request แรก ถ้ายังไม่ได้ migrate จะ log เตือน (ไม่ block request)
+"""
+import logging
+import os
+import sys
+
+from sqlalchemy import func, inspect, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from . import models, pallets
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_CHECK_ENABLED = os.getenv("SCHEMA_CHECK", "1") == "1"
+# ล็อกกันสอง process migrate พร้อมกัน
+MIGRATION_LOCK_ID = 7_310_024
+SCHEMA = "fleetdata"
+
+
+def managed_tables() -> list:
+    """table ที่ bootstrap ดูแล (ไม่รวม view)"""
+    return [t for t in models.Base.metadata.sorted_tables if not t.info.get("is_view")]
+
+
+def _create_tables(conn):
+    models.Base.metadata.create_all(bind=conn, tables=managed_tables(), checkfirst=True)
+
+
+def _index_valid(conn, name):
+    """True = มีและใช้ได้, False = build ค้าง (INVALID), None = ยังไม่มี"""
+    return conn.execute(
+        text(
+            "SELECT i.indisvalid FROM pg_index i"
+            " JOIN pg_class c ON c.oid = i.indexrelid"
+            " JOIN pg_namespace n ON n.oid = c.relnamespace"
+            " WHERE c.relname = :name AND n.nspname = :schema"
+        ),
+        {"name": name, "schema": SCHEMA},
+    ).scalar()
+
+
+def _create_index_concurrently(conn, name, table, definition):
+    valid = _index_valid(conn, name)
+    if valid:
+        return
+    if valid is False:
+        # CONCURRENTLY ที่ล้มกลางทางทิ้ง index INVALID ไว้ ต้องลบก่อน build ใหม่
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {SCHEMA}.{name}"))
+    conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {SCHEMA}.{table} {definition}"))
+
+
+def _create_indexes(indexes):
+    """
+    migration ที่สร้าง index ชุดที่กำหนดตายตัว (name, table, definition)
+    ไม่อ่านจาก model: model เปลี่ยนทีหลัง (เช่นเพิ่ม column ใน migration ถัดไป)
+    แล้ว migration เก่าต้องยังรันบน DB เดิมได้
+    """
+    def run(conn):
+        for name, table, definition in indexes:
+            _create_index_concurrently(conn, name, table, definition)
+    return run
+
+
+# create_all ไม่เพิ่ม index ให้ table ที่มีอยู่แล้ว
+INDEXES_V2 = [
+    ("ix_fleetdata_userdata_username", "userdata", "(username)"),
+    ("ix_fleetdata_jobdata_load_id", "jobdata", "(load_id)"),
+    ("ix_fleetdata_jobdata_group_key_uuid", "jobdata", "(group_key_uuid)"),
+    ("ix_jobdata_driver_name_updated_at", "jobdata", "(driver_name, updated_at)"),
+    ("ix_jobdata_tombstone_driver_name_deleted_at", "jobdata_tombstone", "(driver_name, deleted_at)"),
+    ("ix_fleetdata_ticketdata_load_id", "ticketdata", "(load_id)"),
+    ("ix_fleetdata_palletdata_load_id", "palletdata", "(load_id)"),
+    ("ix_fleetdata_palletlog_timestamp", "palletlog", "(timestamp)"),
+    ("ix_fleetdata_palletlog_driver_name", "palletlog", "(driver_name)"),
+    ("ix_fleetdata_palletlog_t_plate", "palletlog", "(t_plate)"),
+    ("ix_palletlog_t_plate_timestamp", "palletlog", "(t_plate, timestamp DESC)"),
+    ("ix_palletlog_driver_name_timestamp", "palletlog", "(driver_name, timestamp DESC)"),
+    ("ix_fleetdata_vehicle_curent_data_plate_master", "vehicle_curent_data", "(plate_master)"),
+]
+INDEXES_V4 = [
+    ("ix_jobdata_plan_key_load_id", "jobdata", "(coalesce(date_plan, DATE '0001-01-01') DESC, load_id)"),
+]
+INDEXES_V6 = [
+    ("ix_jobdata_driver_name_change_xid", "jobdata", "(driver_name, change_xid)"),
+    ("ix_jobdata_tombstone_driver_name_change_xid", "jobdata_tombstone", "(driver_name, change_xid)"),
+]
+INDEXES_V7 = [
+    ("ix_jobdata_open_plan_key_load_id", "jobdata",
+     "(coalesce(date_plan, DATE '0001-01-01') DESC, load_id)"
+     " WHERE status IS NULL OR status NOT IN ('พร้อมรับงาน', 'จัดส่งแล้ว (POD)')"),
+    ("ix_jobdata_last_plan_key_load_id", "jobdata",
+     "(coalesce(date_plan, DATE '0001-01-01') DESC, load_id)"
+     " WHERE status IN ('พร้อมรับงาน', 'จัดส่งแล้ว (POD)')"),
+]
+
+# /jobs/changes ของ admin ที่ไม่กรองคนขับ: keyset (change_xid, load_id) ทั้ง table
+INDEXES_V8 = [
+    ("ix_jobdata_change_xid_load_id", "jobdata", "(change_xid, load_id)"),
+    ("ix_jobdata_tombstone_change_xid_load_id", "jobdata_tombstone", "(change_xid, load_id)"),
+]
+
+
+def _seed_pallet_balances(conn):
+    # /latest_palletlog อ่านจาก pallet_balance อย่างเดียว ต้องมียอดของ t_plate เดิมก่อน
+    with Session(bind=conn) as db:
+        pallets.rebuild_balances(db)
+
+
+CURRENT_XID_SQL = "pg_current_xact_id()::text::bigint"
+
+
+def _add_change_xid(conn):
+    # ไม่ใส่ default ตอน ADD COLUMN (default แบบ volatile ทำให้ rewrite ทั้ง table)
+    # แถวเดิมเป็น NULL = เปลี่ยนก่อนมี change tracking (ได้จาก snapshot อยู่แล้ว)
+    job = models.Job.__table__.fullname
+    tombstone = models.JobTombstone.__table__.fullname
+    schema = models.Job.__table__.schema
+    conn.execute(text(f"ALTER TABLE {job} ADD COLUMN IF NOT EXISTS change_xid bigint"))
+    conn.execute(text(f"ALTER TABLE {tombstone} ADD COLUMN IF NOT EXISTS change_xid bigint"))
+    conn.execute(text(f"ALTER TABLE {tombstone} ALTER COLUMN change_xid SET DEFAULT {CURRENT_XID_SQL}"))
+    conn.execute(text(f"""
+        CREATE OR REPLACE FUNCTION {schema}.jobdata_change_xid() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            NEW.change_xid := {CURRENT_XID_SQL};
+            RETURN NEW;
+        END
+        $$
+    """))
+    conn.execute(text(f"DROP TRIGGER IF EXISTS jobdata_change_xid ON {job}"))
+    conn.execute(text(
+        f"CREATE TRIGGER jobdata_change_xid BEFORE INSERT OR UPDATE ON {job}"
+        f" FOR EACH ROW EXECUTE FUNCTION {schema}.jobdata_change_xid()"
+    ))
+
+
+def _change_xid_indexes(conn):
+    _create_indexes(INDEXES_V6)(conn)
+    # index ตาม updated_at / deleted_at ของ /jobs/changes แบบเดิม
+    for name in ("ix_jobdata_driver_name_updated_at", "ix_jobdata_tombstone_driver_name_deleted_at"):
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {SCHEMA}.{name}"))
+
+
+def _status_split_plan_indexes(conn):
+    _create_indexes(INDEXES_V7)(conn)
+    # สอง partial index ครอบคลุมทุกแถวแล้ว
+    conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {SCHEMA}.ix_jobdata_plan_key_load_id"))
+
+
+# (version, คำอธิบาย, fn(conn), transactional) เพิ่มต่อท้ายเท่านั้น
+# transactional=False → รันบน connection autocommit นอก advisory lock (เช่น CREATE INDEX CONCURRENTLY)
+# fn ต้องรันซ้ำได้ เผื่อล้มกลางทางแล้วสั่ง migrate ใหม่
+MIGRATIONS = [
+    (1, "tables (ไม่รวม view)", _create_tables, True),
+    (2, "indexes: jobdata / jobdata_tombstone / palletlog", _create_indexes(INDEXES_V2), False),
+    (3, "pallet_balance จาก palletlog เดิม", _seed_pallet_balances, True),
+    (4, "index: jobdata (plan_key, load_id) สำหรับ /jobs", _create_indexes(INDEXES_V4), False),
+    (5, "jobdata / jobdata_tombstone: change_xid + trigger", _add_change_xid, True),
+    (6, "indexes: (driver_name, change_xid) แทน updated_at / deleted_at", _change_xid_indexes, False),
+    (7, "indexes: jobdata (plan_key, load_id) แยกตามสถานะ (partial) สำหรับ /jobs", _status_split_plan_indexes, False),
+    (8, "indexes: jobdata / jobdata_tombstone (change_xid, load_id)", _create_indexes(INDEXES_V8), False),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn) -> int:
+    table = models.SchemaVersion.__table__
+    if not inspect(conn).has_table(table.name, schema=table.schema):
+        return 0
+    return conn.execute(select(func.max(table.c.version))).scalar() or 0
+
+
+def _record_version(conn, version: int, description: str):
+    table = models.SchemaVersion.__table__
+    conn.execute(
+        pg_insert(table)
+        .values(version=version, description=description)
+        .on_conflict_do_nothing(index_elements=[table.c.version])
+    )
+
+
+def migrate(engine) -> list:
+    """
+    apply migration ที่ค้างตามลำดับ คืนรายการ version ที่ apply
+    migration แบบ transactional รันทีละ transaction ภายใต้ advisory lock
+    (กันสอง process migrate พร้อมกัน) ส่วนที่เหลือรันแบบ autocommit
+    """
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+        version_table = models.SchemaVersion.__table__
+        conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {version_table.schema}"))
+        version_table.create(bind=conn, checkfirst=True)
+
+    applied = []
+    for version, description, fn, transactional in MIGRATIONS:
+        if transactional:
+            with engine.begin() as conn:
+                conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+                if version <= current_version(conn):
+                    continue
+                fn(conn)
+                _record_version(conn, version, description)
+        else:
+            with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                if version <= current_version(conn):
+                    continue
+                fn(conn)
+                _record_version(conn, version, description)
+        applied.append(version)
+    return applied
+
+
+# -------------------------
+# LAZY CHECK
+# -------------------------
+_checked = not SCHEMA_CHECK_ENABLED
+
+
+def check_schema_version(db) -> int:
+    """เช็คครั้งเดียวต่อ process (เรียกผ่าน database.run_db)"""
+    global _checked
+    if _checked:
+        return None
+    _checked = True
+    try:
+        version = current_version(db.connection())
+    except Exception:
+        logger.exception("schema version check failed")
+        return None
+    if version < SCHEMA_VERSION:
+        logger.warning(
+            "database schema is at version %s, code expects %s: run `python -m api.bootstrap migrate`",
+            version, SCHEMA_VERSION,
+        )
+    return version
+
+
+def schema_checked() -> bool:
+    return _checked
+
+
+if __name__ == "__main__":
+    from .database import engine
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == "migrate":
+        applied = migrate(engine)
+        print(f"✅ Applied migrations: {applied}" if applied else "✅ Schema is up to date")
+    elif command == "status":
+        with engine.connect() as conn:
+            version = current_version(conn)
+        print(f"schema version {version} / {SCHEMA_VERSION}")
+    else:
+        sys.exit("usage: python -m api.bootstrap [migrate|status]")
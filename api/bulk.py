@@ -0,0 +1,88 @@
+"""
+helper สำหรับเขียนหลายแถวแบบ set-based (หนึ่ง statement ต่อกลุ่ม แทนการวน ORM ทีละแถว)
+"""
+import csv
+import io
+from datetime import datetime
+
+from sqlalchemy import DateTime, cast, column, update, values
+
+from .database import naive_timestamp
+
+# จำนวนแถวต่อ statement
+CHUNK_SIZE = 1000
+
+
+def chunked(rows: list, size: int = CHUNK_SIZE):
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+
+def group_by_columns(rows: list) -> dict:
+    """จัดกลุ่ม dict ตามชุด key ที่ส่งมา (เช่น ฟิลด์ที่ client set จริง)"""
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    return groups
+
+
+def update_from_values(table, key: str, rows: list, columns: list, extra: dict = None, where=None):
+    """
+    UPDATE table SET col = v.col, ... FROM (VALUES ...) AS v WHERE table.key = v.key
+
+    - rows: list ของ dict ที่มี key และทุกคอลัมน์ใน columns
+    - extra: ค่าคงที่ที่ set ให้ทุกแถว (เช่น updated_at)
+    - where: callable(v) คืนเงื่อนไขเพิ่มเติม (อ้างคอลัมน์ของ VALUES ผ่าน v.c)
+    ค่าจาก VALUES ถูก cast เป็น type ของคอลัมน์ปลายทาง (คอลัมน์ที่เป็น NULL ทั้งหมดจะได้ type text)
+    """
+    names = [key] + [c for c in columns if c != key]
+    v = values(
+        *[column(n, table.c[n].type) for n in names],
+        name="v",
+    ).data([tuple(row.get(n) for n in names) for row in rows])
+
+    set_ = {c: cast(v.c[c], table.c[c].type) for c in names if c != key}
+    if extra:
+        set_.update(extra)
+    stmt = update(table).where(table.c[key] == v.c[key]).values(set_)
+    if where is not None:
+        stmt = stmt.where(where(v))
+    return stmt
+
+
+# ค่า NULL ใน COPY (CSV ว่าง "" ยังเป็น string ว่างได้)
+COPY_NULL = r"\N"
+
+
+def copy_rows(db, table, columns: list, rows: list):
+    """
+    COPY table (columns) FROM STDIN แบบ CSV ใน transaction ของ session (psycopg2)
+    เร็วกว่า INSERT หลายเท่าสำหรับ batch ใหญ่ แต่ไม่มี RETURNING / ON CONFLICT
+    """
+    # คอลัมน์ timestamp (ไม่มี tz): COPY ทิ้ง offset ของข้อความเฉยๆ ต้องแปลงเป็นเวลา DB_TIMEZONE ก่อน
+    naive = {
+        c for c in columns
+        if isinstance(table.c[c].type, DateTime) and not table.c[c].type.timezone
+    }
+
+    def copy_value(name, value):
+        if value is None:
+            return COPY_NULL
+        if name in naive and isinstance(value, datetime):
+            return naive_timestamp(value)
+        return value
+
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow([copy_value(c, row.get(c)) for c in columns])
+    buf.seek(0)
+
+    preparer = db.get_bind().dialect.identifier_preparer
+    sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '{}')".format(
+        preparer.format_table(table),
+        ", ".join(preparer.quote(c) for c in columns),
+        COPY_NULL,
+    )
+    with db.connection().connection.cursor() as cursor:
+        cursor.copy_expert(sql, buf)
@@ -1,7 +1,11 @@
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool, QueuePool
+from fastapi.concurrency import run_in_threadpool
 import os
+import uuid
+from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 
 load_dotenv()  # โหลด .env
@@ -9,7 +13,118 @@ load_dotenv()  # โหลด .env
 # ✅ ดึงค่าจาก .env
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# -------------------------
+# DEPLOYMENT MODE
+# -------------------------
+# server     = uvicorn รันยาว → QueuePool ที่ปรับขนาดได้
+# serverless = Mangum / function instance อายุสั้น → NullPool (ให้ pgbouncer ทำ pooling)
+#              และไม่ใช้ prepared statement ฝั่ง server (transaction pooling ใช้ไม่ได้)
+DB_DEPLOYMENT_MODE = os.getenv("DB_DEPLOYMENT_MODE") or (
+    "serverless" if os.getenv("AWS_LAMBDA_FUNCTION_NAME") or os.getenv("VERCEL") else "server"
+)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+
+def engine_options(async_driver: bool = False) -> dict:
+    if DB_DEPLOYMENT_MODE == "serverless":
+        options = {"poolclass": NullPool}
+        if async_driver:
+            # asyncpg cache prepared statement ไว้ต่อ connection → ชนกันผ่าน pgbouncer
+            options["connect_args"] = {
+                "statement_cache_size": 0,
+                "prepared_statement_cache_size": 0,
+                "prepared_statement_name_func": lambda: f"__asyncpg_{uuid.uuid4()}__",
+            }
+        return options
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+    }
+
+
 # ✅ สร้าง engine ด้วย DATABASE_URL จาก .env
-engine = create_engine(DATABASE_URL)
+engine = create_engine(DATABASE_URL, **engine_options())
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 Base = declarative_base()
+
+# คอลัมน์ timestamp (without time zone) เก็บเป็นเวลาท้องถิ่นของโซนนี้
+DB_TIMEZONE = ZoneInfo(os.getenv("DB_TIMEZONE", "Asia/Bangkok"))
+
+
+def naive_timestamp(value):
+    """datetime ที่มี tz (เช่น "...+07:00", "Z") → เวลา DB_TIMEZONE แบบไม่มี tz"""
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(DB_TIMEZONE).replace(tzinfo=None)
+
+
+# -------------------------
+# ASYNC (asyncpg) — เปิดด้วย DB_ASYNC=1
+# -------------------------
+DB_ASYNC = os.getenv("DB_ASYNC", "0") == "1"
+
+
+def _async_url(url: str) -> str:
+    # postgresql://, postgresql+psycopg2:// → postgresql+asyncpg://
+    scheme, rest = url.split("://", 1)
+    return f"postgresql+asyncpg://{rest}" if scheme.startswith("postgres") else url
+
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or (_async_url(DATABASE_URL) if DATABASE_URL else None)
+
+async_engine = None
+AsyncSessionLocal = None
+if DB_ASYNC:
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+    async_engine = create_async_engine(ASYNC_DATABASE_URL, **engine_options(async_driver=True))
+    AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+
+def _pool_stats(pool) -> dict:
+    stats = {"class": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+            max_overflow=DB_MAX_OVERFLOW,
+        )
+    return stats
+
+
+def pool_stats() -> dict:
+    return {
+        "mode": DB_DEPLOYMENT_MODE,
+        "sync": _pool_stats(engine.pool),
+        "async": _pool_stats(async_engine.sync_engine.pool) if async_engine is not None else None,
+    }
+
+
+async def run_db(fn, *args, **kwargs):
+    """
+    รัน fn(db, *args, **kwargs) ที่เขียนแบบ sync Session จาก endpoint แบบ async
+
+    - DB_ASYNC=1 → AsyncSession.run_sync บน asyncpg: รอ I/O บน event loop ไม่จอง thread
+    - ไม่เปิด   → SessionLocal (psycopg2) บน threadpool เหมือน endpoint แบบ def
+    fn ไม่ควรเรียก I/O ที่ไม่ผ่าน db (เช่น pg_notify ผ่าน engine) เพราะจะบล็อก event loop
+    """
+    if AsyncSessionLocal is not None:
+        async with AsyncSessionLocal() as session:
+            return await session.run_sync(lambda db: fn(db, *args, **kwargs))
+
+    def call():
+        db = SessionLocal()
+        try:
+            return fn(db, *args, **kwargs)
+        finally:
+            db.close()
+
+    return await run_in_threadpool(call)
@@ -0,0 +1,156 @@
+"""
+Event broker สำหรับ push สถานะ job / ticket ไปยัง dashboard (SSE)
+
+- EVENTS_BACKEND=memory   (default) fan-out ภายใน process เดียว
+- EVENTS_BACKEND=postgres publish ผ่าน pg_notify แล้วทุก worker LISTEN
+                          ช่องเดียวกันและ fan-out ให้ subscriber ของตัวเอง
+"""
+import asyncio
+import json
+import logging
+import os
+import select
+import threading
+
+from sqlalchemy import text
+
+from .database import engine
+
+logger = logging.getLogger(__name__)
+
+EVENTS_BACKEND = os.getenv("EVENTS_BACKEND", "memory")
+EVENTS_CHANNEL = os.getenv("EVENTS_CHANNEL", "tdm_events")
+
+# subscriber ที่อ่านไม่ทันจะถูกตัด event และได้ "resync" แทน
+SUBSCRIBER_QUEUE_SIZE = 100
+# publish_many: จำนวน payload ต่อ statement pg_notify
+NOTIFY_BATCH_SIZE = 1000
+
+
+class Subscription:
+    def __init__(self, loop, match):
+        self.loop = loop
+        self.match = match
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False
+
+    def offer(self, event: dict):
+        # เรียกบน event loop ของ subscriber เท่านั้น
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+
+class EventBroker:
+    def __init__(self, backend: str = EVENTS_BACKEND, channel: str = EVENTS_CHANNEL):
+        self.backend = backend
+        self.channel = channel
+        self._subs = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._listener = None
+
+    # -------------------------
+    # SUBSCRIBE (เรียกจาก async endpoint)
+    # -------------------------
+    def subscribe(self, match) -> Subscription:
+        sub = Subscription(asyncio.get_running_loop(), match)
+        with self._lock:
+            self._subs.add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        with self._lock:
+            self._subs.discard(sub)
+
+    # -------------------------
+    # PUBLISH (เรียกได้จาก thread ไหนก็ได้ หลัง commit แล้ว)
+    # -------------------------
+    def publish(self, event: dict):
+        self.publish_many([event])
+
+    def publish_many(self, events: list):
+        """event ทั้งหมดของ request เดียว: backend postgres ใช้ connection / transaction เดียว"""
+        if not events:
+            return
+        if self.backend == "postgres":
+            self._notify(events)
+        else:
+            for event in events:
+                self.dispatch(event)
+
+    def dispatch(self, event: dict):
+        with self._lock:
+            subs = list(self._subs)
+        for sub in subs:
+            if not sub.match(event):
+                continue
+            try:
+                sub.loop.call_soon_threadsafe(sub.offer, event)
+            except RuntimeError:
+                # event loop ปิดไปแล้ว
+                self.unsubscribe(sub)
+
+    def _notify(self, events: list):
+        payloads = [json.dumps(event, ensure_ascii=False, default=str) for event in events]
+        try:
+            with engine.begin() as conn:
+                for i in range(0, len(payloads), NOTIFY_BATCH_SIZE):
+                    conn.execute(
+                        text(
+                            "SELECT pg_notify(:channel, payload)"
+                            " FROM unnest(CAST(:payloads AS text[])) AS payload"
+                        ),
+                        {"channel": self.channel, "payloads": payloads[i:i + NOTIFY_BATCH_SIZE]},
+                    )
+        except Exception:
+            # push เป็น best-effort: ข้อมูลจริง commit ไปแล้ว
+            logger.exception("pg_notify failed")
+
+    # -------------------------
+    # LISTEN/NOTIFY (multi-worker)
+    # -------------------------
+    def start(self):
+        if self.backend != "postgres" or self._listener:
+            return
+        self._stop.clear()
+        self._listener = threading.Thread(target=self._listen, name="events-listener", daemon=True)
+        self._listener.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._listener:
+            self._listener.join(timeout=10)
+            self._listener = None
+
+    def _listen(self):
+        while not self._stop.is_set():
+            conn = None
+            try:
+                raw = engine.raw_connection()
+                conn = raw.driver_connection
+                raw.detach()  # connection นี้ใช้ LISTEN ถาวร ไม่คืนเข้า pool
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f'LISTEN "{self.channel}"')
+
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], 5) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            self.dispatch(json.loads(notify.payload))
+                        except ValueError:
+                            logger.warning("invalid event payload: %r", notify.payload)
+            except Exception:
+                logger.exception("events listener error, reconnecting")
+                self._stop.wait(5)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+broker = EventBroker()
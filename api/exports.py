@@ -0,0 +1,112 @@
+"""
+Export แบบ stream (CSV / Parquet)
+
+รับ iterator ของแถว (tuple ตามลำดับ columns) แล้ว yield เป็น bytes ทีละก้อน
+ใช้คู่กับ query ที่เปิด server-side cursor (yield_per) หน่วยความจำจึงคงที่ไม่ว่าจะกี่แถว
+"""
+import csv
+import io
+
+from sqlalchemy import Date, DateTime, Integer
+
+EXPORT_BATCH_SIZE = 5000
+EXPORT_FORMATS = ("csv", "parquet")
+
+
+def csv_chunks(columns: list, rows, batch_size: int = EXPORT_BATCH_SIZE):
+    """CSV (UTF-8 พร้อม BOM ให้ Excel อ่านภาษาไทยได้)"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    buf.write("\ufeff")
+    writer.writerow([c.name for c in columns])
+
+    n = 0
+    for row in rows:
+        writer.writerow(row)
+        n += 1
+        if n % batch_size == 0:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode("utf-8")
+
+
+# -------------------------
+# PARQUET (pyarrow เป็น optional dependency)
+# -------------------------
+def parquet_available() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _arrow_type(pa, column):
+    if isinstance(column.type, DateTime):
+        return pa.timestamp("us", tz="UTC" if column.type.timezone else None)
+    if isinstance(column.type, Date):
+        return pa.date32()
+    if isinstance(column.type, Integer):
+        return pa.int64()
+    return pa.string()
+
+
+def _to_arrow_str(value):
+    # คอลัมน์ที่ map เป็น string (UUID, Interval, ...) แปลงเป็นข้อความ
+    return value if value is None or isinstance(value, str) else str(value)
+
+
+class _ChunkSink(io.RawIOBase):
+    """file-like ที่เก็บ bytes ที่ ParquetWriter เขียนไว้ รอ yield ออกไป"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_chunks(columns: list, rows, batch_size: int = EXPORT_BATCH_SIZE):
+    """Parquet หนึ่ง row group ต่อ batch_size แถว"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([pa.field(c.name, _arrow_type(pa, c)) for c in columns])
+    string_cols = {i for i, f in enumerate(schema) if f.type == pa.string()}
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+
+    def write_batch(batch):
+        data = list(zip(*batch)) if batch else [[] for _ in columns]
+        arrays = [
+            pa.array([_to_arrow_str(v) for v in values] if i in string_cols else values, type=schema[i].type)
+            for i, values in enumerate(data)
+        ]
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+    batch = []
+    for row in rows:
+        batch.append(tuple(row))
+        if len(batch) == batch_size:
+            write_batch(batch)
+            batch = []
+            yield sink.drain()
+    if batch:
+        write_batch(batch)
+    writer.close()
+    yield sink.drain()
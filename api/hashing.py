@@ -0,0 +1,95 @@
+"""
+Pool สำหรับงาน hash / verify รหัสผ่าน (Argon2)
+
+Argon2 กิน CPU + RAM ต่อครั้งสูง ถ้ารันบน threadpool ของ request ตรงๆ
+ช่วงคนขับ login พร้อมกันจะดึง thread ไปหมดจน /jobs, /gpsdata รอคิว
+- HASH_WORKERS        จำนวน thread ที่ hash พร้อมกันได้
+- HASH_MAX_PENDING    งานที่รับไว้ได้ทั้งหมด (กำลังทำ + รอคิว) เกินนี้ → HashPoolBusy ทันที
+argon2-cffi ปล่อย GIL ระหว่าง hash จึงใช้ thread ได้เต็มจำนวน core
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+HASH_MAX_PENDING = int(os.getenv("HASH_MAX_PENDING", "16"))
+HASH_RETRY_AFTER_SECONDS = int(os.getenv("HASH_RETRY_AFTER_SECONDS", "2"))
+
+# ช่วงเวลาที่ใช้คำนวณ hashes/sec
+RATE_WINDOW_SECONDS = 60
+
+
+class HashPoolBusy(Exception):
+    """งานค้างเต็ม HASH_MAX_PENDING"""
+
+
+class HashPool:
+    def __init__(self, workers: int = HASH_WORKERS, max_pending: int = HASH_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hash")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._completed = 0
+        self._rejected = 0
+        self._busy_seconds = 0.0
+        self._recent = deque()   # เวลาที่งานเสร็จ (monotonic) ภายใน RATE_WINDOW_SECONDS
+
+    def _timed(self, fn, args):
+        started = time.monotonic()
+        try:
+            return fn(*args)
+        finally:
+            finished = time.monotonic()
+            with self._lock:
+                self._completed += 1
+                self._busy_seconds += finished - started
+                self._recent.append(finished)
+                self._prune(finished)
+
+    def _prune(self, now: float):
+        # เรียกภายใต้ self._lock: deque ไม่โตเกินจำนวนงานใน RATE_WINDOW_SECONDS
+        while self._recent and self._recent[0] < now - RATE_WINDOW_SECONDS:
+            self._recent.popleft()
+
+    def _done(self, _future):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    def submit(self, fn, *args):
+        """คืน concurrent.futures.Future (async ใช้ asyncio.wrap_future ได้)"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise HashPoolBusy(f"{self.max_pending} hash jobs pending")
+        with self._lock:
+            self._pending += 1
+        future = self._executor.submit(self._timed, fn, args)
+        future.add_done_callback(self._done)
+        return future
+
+    def run(self, fn, *args):
+        """รันบน pool แล้วรอผล (เรียกจาก endpoint แบบ sync, async ใช้ submit + asyncio.wrap_future)"""
+        return self.submit(fn, *args).result()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            completed = self._completed
+            return {
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "pending": self._pending,
+                "completed": completed,
+                "rejected": self._rejected,
+                "hashes_per_second": round(len(self._recent) / RATE_WINDOW_SECONDS, 3),
+                "avg_ms": round(self._busy_seconds / completed * 1000, 1) if completed else None,
+            }
+
+
+pool = HashPool()
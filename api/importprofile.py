@@ -0,0 +1,106 @@
+"""
+วัดเวลา import (cold start) ของ app แยกตาม module
+
+    python -m api.importprofile                       # top 25 module ของ api.index
+    python -m api.importprofile --top 40 --runs 5
+    python -m api.importprofile --budget-ms 600       # exit 1 ถ้าเกิน budget (default IMPORT_BUDGET_MS)
+
+รัน `python -X importtime -c "import <module>"` ใน process ใหม่ทุกรอบ
+ผลจึงเป็นเวลา import ตอน cold start จริง (ไม่มี module ค้างใน sys.modules)
+ไม่ต่อ DB: ถ้าไม่ได้ตั้ง DATABASE_URL จะใส่ค่า placeholder ให้ engine สร้างได้เฉยๆ
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+DEFAULT_MODULE = "api.index"
+# cold start ตอนนี้ ~350 ms (fastapi + sqlalchemy เป็นส่วนใหญ่) เผื่อเครื่อง CI ช้าไว้
+# 0 = ไม่เช็ค budget (tests/test_importprofile.py รันเช็คนี้ทุกครั้ง)
+IMPORT_BUDGET_MS = float(os.getenv("IMPORT_BUDGET_MS", "1000"))
+PLACEHOLDER_DATABASE_URL = "postgresql+psycopg2://profile@localhost/profile"
+
+
+def run_importtime(module: str) -> list:
+    """คืน [(module, self_us, cumulative_us)] ตามลำดับที่ -X importtime พิมพ์"""
+    env = dict(os.environ)
+    env.setdefault("DATABASE_URL", PLACEHOLDER_DATABASE_URL)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=env,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr}")
+
+    rows = []
+    for line in result.stderr.splitlines():
+        # "import time:       self [us] |  cumulative | imported package"
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue
+        rows.append((parts[2].strip(), int(parts[0]), int(parts[1])))
+    return rows
+
+
+def total_us(rows: list, module: str) -> int:
+    for name, _self_us, cumulative in rows:
+        if name == module:
+            return cumulative
+    return sum(self_us for _name, self_us, _cumulative in rows)
+
+
+def by_package(rows: list) -> dict:
+    """รวม self time ตาม top-level package (fastapi, sqlalchemy, api, ...)"""
+    totals = defaultdict(int)
+    for name, self_us, _cumulative in rows:
+        totals[name.split(".", 1)[0]] += self_us
+    return dict(totals)
+
+
+def _ms(us: int) -> str:
+    return f"{us / 1000:8.1f} ms"
+
+
+def report(rows: list, module: str, top: int):
+    print(f"📦 import {module}: {_ms(total_us(rows, module)).strip()}")
+
+    print(f"\nTop {top} modules (cumulative):")
+    for name, self_us, cumulative in sorted(rows, key=lambda r: r[2], reverse=True)[:top]:
+        print(f"  {_ms(cumulative)}  self {_ms(self_us)}  {name}")
+
+    print(f"\nTop {top} packages (self):")
+    packages = sorted(by_package(rows).items(), key=lambda kv: kv[1], reverse=True)
+    for name, self_us in packages[:top]:
+        print(f"  {_ms(self_us)}  {name}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m api.importprofile", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--module", default=DEFAULT_MODULE)
+    parser.add_argument("--top", type=int, default=25)
+    parser.add_argument("--runs", type=int, default=3, help="ใช้ค่ากลาง (median) ของทุกรอบ")
+    parser.add_argument("--budget-ms", type=float, default=IMPORT_BUDGET_MS)
+    args = parser.parse_args(argv)
+
+    runs = [run_importtime(args.module) for _ in range(max(1, args.runs))]
+    totals = [total_us(rows, args.module) for rows in runs]
+    median_us = statistics.median(totals)
+    # แสดงรายละเอียดของรอบที่ใกล้ค่ากลางที่สุด
+    report(min(runs, key=lambda rows: abs(total_us(rows, args.module) - median_us)), args.module, args.top)
+
+    print(f"\n⏱️ median of {len(totals)} runs: {median_us / 1000:.1f} ms "
+          f"({', '.join(f'{t / 1000:.1f}' for t in totals)})")
+    if args.budget_ms and median_us / 1000 > args.budget_ms:
+        print(f"❌ Import time exceeds budget of {args.budget_ms:.0f} ms")
+        return 1
+    if args.budget_ms:
+        print(f"✅ Within budget of {args.budget_ms:.0f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""
+อ่านแผนงานจากไฟล์ CSV / XLSX ทีละแถว แล้ว validate กับ JobUpdateSchemaCreate
+
+ไม่โหลดทั้งไฟล์เข้าหน่วยความจำ: CSV อ่านผ่าน csv.DictReader,
+XLSX อ่านด้วย openpyxl แบบ read_only
+"""
+import codecs
+import csv
+import zipfile
+from itertools import islice
+from typing import Optional
+
+from pydantic import ValidationError
+
+from .schemas import JobUpdateSchemaCreate
+
+IMPORT_BATCH_SIZE = 1000
+IMPORT_FORMATS = ("csv", "xlsx")
+IMPORT_FIELDS = set(JobUpdateSchemaCreate.model_fields)
+# load_id ถูกจองให้ใหม่เสมอ ไม่รับจากไฟล์
+IMPORT_IGNORED = {"load_id", "created_at", "created_by", "updated_at", "updated_by"}
+IMPORT_REQUIRED = {
+    name for name, field in JobUpdateSchemaCreate.model_fields.items() if field.is_required()
+}
+# ฟิลด์ข้อความ: Excel ให้ตัวเลขเป็น int/float (phone, h_plate, ...) ซึ่ง pydantic ไม่แปลงเป็น str ให้
+IMPORT_STR_FIELDS = {
+    name for name, field in JobUpdateSchemaCreate.model_fields.items()
+    if field.annotation in (str, Optional[str])
+}
+
+
+class ImportFileError(ValueError):
+    """ไฟล์ใช้ไม่ได้ทั้งไฟล์ (header ผิด, format ไม่รู้จัก)"""
+
+
+def detect_format(filename: str) -> str:
+    ext = (filename or "").rsplit(".", 1)[-1].lower()
+    if ext not in IMPORT_FORMATS:
+        raise ImportFileError("Only .csv or .xlsx files are supported")
+    return ext
+
+
+def _header(names) -> list:
+    header = [str(n).strip().lower() if n is not None else "" for n in names]
+    unknown = [n for n in header if n and n not in IMPORT_FIELDS]
+    if unknown:
+        raise ImportFileError(f"Unknown column: {', '.join(unknown)}")
+    missing = IMPORT_REQUIRED - set(header)
+    if missing:
+        raise ImportFileError(f"Missing column: {', '.join(sorted(missing))}")
+    return header
+
+
+def _record(header: list, values) -> dict:
+    record = {}
+    for name, value in zip(header, values):
+        if not name or name in IMPORT_IGNORED:
+            continue
+        if name in IMPORT_STR_FIELDS and isinstance(value, (int, float)) and not isinstance(value, bool):
+            # 812345678.0 → "812345678"
+            value = str(int(value)) if isinstance(value, float) and value.is_integer() else str(value)
+        if isinstance(value, str):
+            value = value.strip()
+        record[name] = None if value == "" else value
+    return record
+
+
+def iter_csv(fileobj):
+    """yield (เลขแถวในไฟล์, dict) — แถวที่ 1 คือ header"""
+    reader = csv.reader(codecs.iterdecode(fileobj, "utf-8-sig"))
+    header = _header(next(reader, []))
+    for line_no, values in enumerate(reader, start=2):
+        if any(v.strip() for v in values):
+            yield line_no, _record(header, values)
+
+
+def iter_xlsx(fileobj):
+    """yield (เลขแถวในไฟล์, dict) จาก sheet แรก"""
+    from openpyxl import load_workbook
+    from openpyxl.utils.exceptions import InvalidFileException
+
+    try:
+        workbook = load_workbook(fileobj, read_only=True, data_only=True)
+    except (zipfile.BadZipFile, InvalidFileException, KeyError):
+        # ไม่ใช่ zip / ไฟล์เสีย / ไม่มี part ที่ xlsx ต้องมี
+        raise ImportFileError("Invalid or corrupt .xlsx file")
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = _header(next(rows, ()))
+        for line_no, values in enumerate(rows, start=2):
+            if any(v is not None and str(v).strip() for v in values):
+                yield line_no, _record(header, values)
+    finally:
+        workbook.close()
+
+
+def _error_message(e: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(p) for p in err['loc']) or 'row'}: {err['msg']}" for err in e.errors()
+    )
+
+
+def validate_rows(records):
+    """yield (เลขแถว, JobUpdateSchemaCreate หรือ None, error หรือ None)"""
+    for line_no, record in records:
+        try:
+            yield line_no, JobUpdateSchemaCreate(**record), None
+        except ValidationError as e:
+            yield line_no, None, _error_message(e)
+
+
+def batches(iterable, size: int = IMPORT_BATCH_SIZE):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
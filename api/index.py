@@ -1,22 +1,45 @@
-from fastapi import FastAPI, Depends, HTTPException, Body, Query, status
+from fastapi import FastAPI, Depends, HTTPException, Body, Header, Query, Request, UploadFile, File, status
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy import select, update, case, and_, or_, func, tuple_, literal, union_all, cast, Integer, BigInteger, Text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import aggregate_order_by, insert as pg_insert
 from datetime import date, timedelta, datetime
-from sqlalchemy import desc
-from fastapi.responses import JSONResponse
-from typing import Optional
-from . import models, auth, database
-from .database import SessionLocal
-from .schemas import TicketUpdate , PalletDataUpdate , JobSchema , JobUpdateSchema , JobSchemaPut , JobUpdateSchemaCreate , RegisterRequest , ChangePasswordRequest , PalletLogRead , LatestPalletLogRead , UserSchema , VehicleCurrentDataOut , VehicleCurrentDataCreate
-from fastapi import Header, HTTPException, status
-from datetime import datetime
-from typing import List
-from .auth import hash_password
-from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
+from typing import List, Optional, Union
+from contextlib import asynccontextmanager
+import asyncio
+import base64
 import hashlib
+import json
+import orjson
+from . import models, auth, database, events, vehicles, status_engine, load_ids, bulk, pallets, exports, imports, hashing, bootstrap
+from .database import SessionLocal
+from .schemas import (
+    TicketUpdate, PalletDataUpdate, JobSchemaPut, JobUpdateSchemaCreate, JobBulkDeleteRequest,
+    RegisterRequest, ChangePasswordRequest, PalletLogCreate, PalletLogOut, PalletLogRead,
+    LatestPalletLogRead, VehicleCurrentDataCreate,
+)
+from .auth import hash_password
+
+# schema ไม่ถูกสร้างตอน import อีกแล้ว: รัน `python -m api.bootstrap migrate` ตอน deploy
+async def check_schema():
+    if not bootstrap.schema_checked():
+        await database.run_db(bootstrap.check_schema_version)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    events.broker.start()
+    if vehicles.GPS_BUFFER_ENABLED:
+        vehicles.gps_buffer.start()
+    yield
+    if vehicles.GPS_BUFFER_ENABLED:
+        vehicles.gps_buffer.stop()  # flush ตำแหน่งที่ค้างก่อนปิด
+    events.broker.stop()
 
-models.Base.metadata.create_all(bind=database.engine)
 
 app = FastAPI(
     title="TDM Backend API",
@@ -25,7 +48,9 @@ app = FastAPI(
     contact={
         "name": "Plug",
         "email": "narongkorn.a@menatransport.co.th",
-    }
+    },
+    lifespan=lifespan,
+    dependencies=[Depends(check_schema)],
 )
 @app.get("/")
 def root():
@@ -39,6 +64,24 @@ def get_db():
     finally:
         db.close()
 
+# --- ETag / conditional GET ---
+def _etag(*parts) -> str:
+    """strong ETag จาก version signal (ค่า aggregate ถูกๆ) + query ของ request"""
+    raw = json.dumps(parts, default=str, separators=(",", ":")).encode()
+    return '"' + hashlib.sha1(raw).hexdigest() + '"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or any(t.removeprefix("W/") == etag for t in tags)
+
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+
 # --- Login ---
 API_SECRET_KEY = "=E=QY]!{PjD53Mq"
 
@@ -49,13 +92,24 @@ def verify_api_key(x_api_key: str = Header(...)):
             detail="Invalid or missing API Key"
         )
 
+@app.get("/metrics/hashing")
+def hashing_metrics(api_key: str = Depends(verify_api_key)):
+    """📊 สถานะ pool hash รหัสผ่าน (pending, rejected, hashes/sec)"""
+    return hashing.pool.stats()
+
+
+@app.get("/metrics/db")
+def db_pool_metrics(api_key: str = Depends(verify_api_key)):
+    """📊 deployment mode + สถานะ connection pool (sync / async)"""
+    return database.pool_stats()
+
 @app.post("/login")
-def login(
+async def login(
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_db),
     latlng_current: str | None = Header(default=None)  # optional header
 ):
-    user = auth.authenticate_user(db, form_data.username, form_data.password)
+    # verify บน hash pool แล้ว await: ช่วงคนขับ login พร้อมกันไม่ดึง thread ของ request อื่นไปรอ
+    user, new_hash = await auth.authenticate_user_async(form_data.username, form_data.password)
     if not user:
         raise HTTPException(status_code=400, detail="Incorrect username or password")
 
@@ -63,11 +117,23 @@ def login(
     timestamp_login = datetime.now(ZoneInfo("Asia/Bangkok"))
 
     # ✅ Update user record in DB
-    user.latlng_current = latlng_current
-    user.timestamp_login = timestamp_login
-    db.add(user)
-    db.commit()
-    db.refresh(user)  # make sure updated fields are available in this session
+    values = {
+        models.User.latlng_current: latlng_current,
+        models.User.timestamp_login: timestamp_login,
+    }
+    if new_hash:
+        # rehash ด้วยพารามิเตอร์ Argon2 ปัจจุบัน
+        values[models.User.hashed_password] = new_hash
+
+    def record_login(db: Session):
+        db.execute(
+            update(models.User)
+            .where(models.User.username == user.username)
+            .values(values)
+        )
+        db.commit()
+
+    await database.run_db(record_login)
 
     # Token payload
     token_data = {
@@ -103,13 +169,14 @@ def register(
     user = models.User(username=data.username, hashed_password=hashed, role=data.role)
     db.add(user)
     db.commit()
+    auth.invalidate_principal(data.username)
     return {"message": f"User '{data.username}' registered successfully!"}
 
 @app.post("/users/reset-password")
 def change_password(
     data: ChangePasswordRequest = Body(...),
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: auth.Principal = Depends(auth.get_current_user),
 ):
     # ตรวจสอบว่า user ที่จะเปลี่ยนเป็นของตัวเอง หรือถ้าเป็น admin เปลี่ยนให้คนอื่นได้
     if current_user.role != "admin" and current_user.username != data.user:
@@ -128,17 +195,28 @@ def change_password(
     # update password ใหม่
     user.hashed_password = hash_password(data.new_password)
     db.commit()
+    auth.invalidate_principal(data.user)
 
     return {"message": f"Password for '{data.user}' changed successfully"}
 
-from zoneinfo import ZoneInfo
-from datetime import datetime
 
 @app.get("/user")
 def get_users(
+    request: Request,
+    response: Response,
     db: Session = Depends(get_db),
     api_key: str = Depends(verify_api_key),
+    if_none_match: Optional[str] = Header(None),
 ):
+    version = db.execute(
+        select(func.count(), func.max(models.User.timestamp_login))
+        .where(models.User.role == "user")
+    ).one()
+    etag = _etag("user", tuple(version), request.url.query)
+    if _etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+    response.headers["ETag"] = etag
+
     users = db.query(models.User).filter(models.User.role == "user").all()
     result = []
 
@@ -175,173 +253,714 @@ def get_users(
     return {"users": result}
 
 
-@app.get("/jobs")
-def get_jobs(
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user),
+# สถานะที่ถูกดันไปท้ายรายการ (ที่เหลือขึ้นก่อน)
+JOB_SORT_LAST_STATUSES = models.JOB_SORT_LAST_STATUSES
+# admin ไม่ส่ง limit → ได้หน้าละเท่านี้ (has_more = true แล้วไล่ต่อด้วย next_cursor)
+# ต้องการทั้งหมดในครั้งเดียวแบบเดิมให้ส่ง all=true
+JOBS_ADMIN_DEFAULT_LIMIT = 500
 
-    load_id: Optional[List[str]] = Query(None),
-    h_plate: Optional[List[str]] = Query(None),
-    t_plate: Optional[List[str]] = Query(None),
-    locat_recive: Optional[List[str]] = Query(None),
-    date_recive: Optional[List[str]] = Query(None),
-    locat_deliver: Optional[List[str]] = Query(None),
-    date_deliver: Optional[List[str]] = Query(None),
-    driver_name: Optional[List[str]] = Query(None),
-    status: Optional[List[str]] = Query(None),
-    date_plan_start: Optional[date] = Query(None),
-    date_plan_end: Optional[date] = Query(None),
+def _job_filters(
+    current_user,
+    load_id=None, h_plate=None, t_plate=None,
+    locat_recive=None, date_recive=None,
+    locat_deliver=None, date_deliver=None,
+    driver_name=None, status=None,
+    date_plan_start=None, date_plan_end=None,
 ):
-    query = db.query(models.Job)
+    """
+    สร้างเงื่อนไข WHERE ของ /jobs ตาม role และ query params
+    """
+    conditions = []
 
     # === 1. Filter by role ===
     if current_user.role != "admin":
-        query = query.filter(models.Job.driver_name == current_user.username)
+        conditions.append(models.Job.driver_name == current_user.username)
 
     # === 2. Filter date_plan ===
     if date_plan_start:
-        query = query.filter(models.Job.date_plan >= date_plan_start)
+        conditions.append(models.Job.date_plan >= date_plan_start)
     if date_plan_end:
-        query = query.filter(models.Job.date_plan <= date_plan_end)
+        conditions.append(models.Job.date_plan <= date_plan_end)
 
     # === 3. Default 7-day window for non-admins ===
     if current_user.role != "admin" and not date_plan_start and not date_plan_end:
         today_date = date.today()
         start_date = today_date - timedelta(days=7)
         end_date = today_date + timedelta(days=7)
-        query = query.filter(
-            models.Job.date_recive >= start_date,
-            models.Job.date_recive <= end_date
-        )
+        conditions.append(models.Job.date_recive >= start_date)
+        conditions.append(models.Job.date_recive <= end_date)
 
     # === 4. Field filters ===
     if load_id:
-        query = query.filter(models.Job.load_id.in_(load_id))
+        conditions.append(models.Job.load_id.in_(load_id))
     if h_plate:
-        query = query.filter(models.Job.h_plate.in_(h_plate))
+        conditions.append(models.Job.h_plate.in_(h_plate))
     if t_plate:
-        query = query.filter(models.Job.t_plate.in_(t_plate))
+        conditions.append(models.Job.t_plate.in_(t_plate))
     if locat_recive:
-        query = query.filter(models.Job.locat_recive.in_(locat_recive))
+        conditions.append(models.Job.locat_recive.in_(locat_recive))
+    # คอลัมน์ timestamp (ไม่มี tz): แปลงค่าก่อน bind (asyncpg ไม่แปลง str / tz ให้เหมือน psycopg2)
     if date_recive:
-        query = query.filter(models.Job.date_recive.in_(date_recive))
+        conditions.append(models.Job.date_recive.in_([database.naive_timestamp(d) for d in date_recive]))
     if locat_deliver:
-        query = query.filter(models.Job.locat_deliver.in_(locat_deliver))
+        conditions.append(models.Job.locat_deliver.in_(locat_deliver))
     if date_deliver:
-        query = query.filter(models.Job.date_deliver.in_(date_deliver))
+        conditions.append(models.Job.date_deliver.in_([database.naive_timestamp(d) for d in date_deliver]))
     if driver_name:
-        query = query.filter(models.Job.driver_name.in_(driver_name))
+        conditions.append(models.Job.driver_name.in_(driver_name))
     if status:
-        query = query.filter(
+        conditions.append(
             func.lower(func.trim(models.Job.status)).in_(
                 [s.strip().lower() for s in status]
             )
         )
+    return conditions
+
+
+def _job_segments(today: date) -> list:
+    """
+    ลำดับของ /jobs:
+    1) สถานะที่ไม่ใช่ JOB_SORT_LAST_STATUSES ขึ้นก่อน (status_rank 0/1)
+    2) งานของวันนี้ (date_plan == today) ขึ้นก่อน (today_rank 0/1)
+    3) date_plan ใหม่ -> เก่า (NULL อยู่ท้าย), load_id
+    rank ทั้งสองมีแค่ 0/1 จึงแบ่งเป็น 4 ช่วง [(status_rank, today_rank, where)]
+    แต่ละช่วงเรียงตาม (plan_key DESC, load_id) อ่านตาม partial index
+    ix_jobdata_open_plan_key_load_id / ix_jobdata_last_plan_key_load_id ได้
+    (เงื่อนไขสถานะต้องเป็น expression เดียวกับ WHERE ของ index)
+    """
+    plan_key = models.JOB_PLAN_KEY
+    status_where = [models.JOB_OPEN_STATUS, models.JOB_LAST_STATUS]
+    today_where = [plan_key == today, plan_key != today]
+    return [(s, t, and_(status_where[s], today_where[t])) for s in (0, 1) for t in (0, 1)]
+
+
+def _job_keyset_after(after: dict):
+    """WHERE สำหรับแถวที่อยู่ถัดจาก cursor ภายในช่วงเดียวกัน"""
+    plan_key = models.JOB_PLAN_KEY
+    p, lid = after["p"], after["id"]
+    return or_(plan_key < p, and_(plan_key == p, models.Job.load_id > lid))
 
-    jobs = query.all()
 
-    # === Sorting ===
-    sorted_jobs = sorted(
-        jobs,
-        key=lambda job: (
-            0 if job.status not in ["พร้อมรับงาน", "จัดส่งแล้ว (POD)"] else 1,
-            0 if job.date_plan == date.today() else 1,
-            -job.date_plan.toordinal() if job.date_plan else 0
+def _job_page_query(columns: list, conditions: list, includes: set, today: date, after, limit):
+    """
+    UNION ALL ของแต่ละช่วง (ข้ามช่วงที่อยู่ก่อน cursor) แต่ละช่วงตัดที่ limit + 1
+    จึงอ่าน index ไม่เกิน 4 × (limit + 1) แถวไม่ว่า table จะใหญ่แค่ไหน
+    """
+    plan_key = models.JOB_PLAN_KEY
+    parts = []
+    for s, t, segment in _job_segments(today):
+        if after and (s, t) < (after["s"], after["t"]):
+            continue
+        part = (
+            select(
+                *columns,
+                literal(s, Integer).label("status_rank"),
+                literal(t, Integer).label("today_rank"),
+                plan_key.label("plan_key"),
+                models.Job.load_id.label("sort_load_id"),
+            )
+            .select_from(models.Job)
+            .where(*conditions, segment)
         )
+        part = _with_job_sideloads(part, includes)
+        if after and (s, t) == (after["s"], after["t"]):
+            part = part.where(_job_keyset_after(after))
+        if limit:
+            part = part.order_by(plan_key.desc(), models.Job.load_id).limit(limit + 1)
+        parts.append(part)
+
+    page = union_all(*parts).subquery()
+    stmt = select(page).order_by(
+        page.c.status_rank, page.c.today_rank, page.c.plan_key.desc(), page.c.sort_load_id
     )
+    return stmt.limit(limit + 1) if limit else stmt
 
-    # === Lookup all drivers ===
-    driver_names = {job.driver_name for job in sorted_jobs if job.driver_name}
-    users = db.query(models.User).filter(models.User.username.in_(driver_names)).all()
-    user_map = {u.username: u for u in users}
 
-    # === Lookup all tickets ===
-    load_ids = {job.load_id for job in sorted_jobs if job.load_id}
-    tickets = db.query(models.Ticket).filter(models.Ticket.load_id.in_(load_ids)).all()
-    ticket_map = {t.load_id: t for t in tickets}
-    
-    # === Lookup all dw_jobdata ===
-    dw_jobs = db.query(models.DWJobData).filter(models.DWJobData.load_id.in_(load_ids)).all()
-    dw_map = {d.load_id: d for d in dw_jobs}
-    
-    h_plates = {job.h_plate for job in sorted_jobs if job.h_plate}
-    vehicles = (
-        db.query(models.VehicleCurrentData)
-        .filter(models.VehicleCurrentData.plate_master.in_(h_plates))
-        .all()
-    )
-    vehicle_map = {v.plate_master: v for v in vehicles}
-    
-    job_dicts = []
-    for job in sorted_jobs:
-        job_dict = job.__dict__.copy()
+def _encode_cursor(payload: dict) -> str:
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
 
-        # Add driver info
-        driver = user_map.get(job.driver_name)
-        job_dict["driver_info"] = {
-            "latlng_current": driver.latlng_current if driver else None,
-            "timestamp_login": (
-                driver.timestamp_login.astimezone(ZoneInfo("Asia/Bangkok")).isoformat()
-                if driver and driver.timestamp_login else None
-            )
-        }
 
-        # Add ticket info
-        ticket = ticket_map.get(job.load_id)
-        job_dict["ticket_info"] = {
-            "start_datetime": ticket.start_datetime if ticket else None,
-            "origin_datetime": ticket.origin_datetime if ticket else None,
-            "start_recive_datetime": ticket.start_recive_datetime if ticket else None,
-            "end_recive_datetime": ticket.end_recive_datetime if ticket else None,
-            "intransit_datetime": ticket.intransit_datetime if ticket else None,
-            "desination_datetime": ticket.desination_datetime if ticket else None,
-            "start_unload_datetime": ticket.start_unload_datetime if ticket else None,
-            "end_unload_datetime": ticket.end_unload_datetime if ticket else None,
-            "complete_datetime": ticket.complete_datetime if ticket else None,
-            "docs_submitted_datetime": ticket.docs_submitted_datetime if ticket else None,
-            "docs_returned_datetime": ticket.docs_returned_datetime if ticket else None,
-
-            # ---- latlng fields ----
-            "start_latlng": ticket.start_latlng if ticket else None,
-            "origin_latlng": ticket.origin_latlng if ticket else None,
-            "start_recive_latlng": ticket.start_recive_latlng if ticket else None,
-            "end_recive_latlng": ticket.end_recive_latlng if ticket else None,
-            "intransit_latlng": ticket.intransit_latlng if ticket else None,
-            "desination_latlng": ticket.desination_latlng if ticket else None,
-            "start_unload_latlng": ticket.start_unload_latlng if ticket else None,
-            "end_unload_latlng": ticket.end_unload_latlng if ticket else None,
-            "complete_latlng": ticket.complete_latlng if ticket else None,
-            "docs_submitted_latlng": ticket.docs_submitted_latlng if ticket else None,
-            "docs_returned_latlng": ticket.docs_returned_latlng if ticket else None,
+def _decode_cursor(cursor: str) -> dict:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return payload
+
+
+def _encode_job_cursor(row, today: date) -> str:
+    return _encode_cursor({
+        "today": today.isoformat(),
+        "s": row.status_rank,
+        "t": row.today_rank,
+        "p": row.plan_key.isoformat(),
+        "id": row.sort_load_id,
+    })
+
+
+def _decode_job_cursor(cursor: str) -> dict:
+    payload = _decode_cursor(cursor)
+    try:
+        return {
+            # ใช้ "วันนี้" เดียวกับหน้าแรก ลำดับจะได้ไม่เลื่อนข้ามเที่ยงคืน
+            "today": date.fromisoformat(payload["today"]),
+            "s": int(payload["s"]),
+            "t": int(payload["t"]),
+            "p": date.fromisoformat(payload["p"]),
+            "id": str(payload["id"]),
         }
-        # DWJobData info
-        dw = dw_map.get(job.load_id)
-        job_dict["dw_jobdata_info"] = {
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
-            "client_kpi_origin": dw.client_kpi_origin if dw else None,
-            "client_kpi_destination": dw.client_kpi_destination if dw else None,
 
-        }
-        
-            # ---- Vehicle Info (NEW) ----
-        vehicle = vehicle_map.get(job.h_plate)
-        job_dict["vehicle_info"] = {
-            "gps_vendor": vehicle.gps_vendor if vehicle else None,
-            "gps_id": vehicle.gps_id if vehicle else None,
-            "current_latlng": vehicle.current_latlng if vehicle else None,
-            "status": vehicle.status if vehicle else None,
-            "gps_updated_at": (
-                vehicle.gps_updated_at.isoformat()
-                if vehicle and vehicle.gps_updated_at else None
+JOB_FIELDS = [c.name for c in models.Job.__table__.columns]
+JOB_INCLUDES = ("driver", "ticket", "dw", "vehicle")
+
+TICKET_INFO_FIELDS = [
+    "start_datetime",
+    "origin_datetime",
+    "start_recive_datetime",
+    "end_recive_datetime",
+    "intransit_datetime",
+    "desination_datetime",
+    "start_unload_datetime",
+    "end_unload_datetime",
+    "complete_datetime",
+    "docs_submitted_datetime",
+    "docs_returned_datetime",
+
+    # ---- latlng fields ----
+    "start_latlng",
+    "origin_latlng",
+    "start_recive_latlng",
+    "end_recive_latlng",
+    "intransit_latlng",
+    "desination_latlng",
+    "start_unload_latlng",
+    "end_unload_latlng",
+    "complete_latlng",
+    "docs_submitted_latlng",
+    "docs_returned_latlng",
+]
+DW_INFO_FIELDS = ["client_kpi_origin", "client_kpi_destination"]
+VEHICLE_INFO_FIELDS = ["gps_vendor", "gps_id", "current_latlng", "status", "gps_updated_at"]
+
+
+def _json_response(payload) -> Response:
+    """serialize ด้วย orjson ตรงๆ (ข้าม jsonable_encoder)"""
+    return Response(orjson.dumps(payload, default=str), media_type="application/json")
+
+
+def _parse_job_fields(fields: Optional[str]) -> list:
+    """fields=load_id,status,... -> รายชื่อคอลัมน์ของ Job (ไม่ส่ง = ทุกคอลัมน์)"""
+    if not fields:
+        return JOB_FIELDS
+    names = list(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+    unknown = [f for f in names if f not in JOB_FIELDS]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown field: {', '.join(unknown)}"
+        )
+    return names
+
+
+def _job_columns(names: list) -> list:
+    return [getattr(models.Job, f) for f in names]
+
+
+def _parse_job_includes(include: Optional[str]) -> set:
+    if include is None:
+        return set(JOB_INCLUDES)
+    includes = {i.strip() for i in include.split(",") if i.strip()}
+    unknown = includes - set(JOB_INCLUDES)
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown include: {', '.join(sorted(unknown))}"
+        )
+    return includes
+
+
+def _with_job_sideloads(stmt, includes: set):
+    """
+    LEFT JOIN ข้อมูลประกอบของ job ใน query เดียว
+    (ตารางที่ join มี key unique ส่วน view dw_jobdata ไม่รับประกัน → เลือก 1 แถวต่อ load_id
+    ก่อน join ไม่ให้จำนวนแถวเพิ่มจน keyset / limit ผิด)
+    """
+    if "driver" in includes:
+        stmt = stmt.add_columns(
+            models.User.latlng_current.label("driver__latlng_current"),
+            models.User.timestamp_login.label("driver__timestamp_login"),
+        ).outerjoin(models.User, models.User.username == models.Job.driver_name)
+    if "ticket" in includes:
+        stmt = stmt.add_columns(
+            *[getattr(models.Ticket, f).label(f"ticket__{f}") for f in TICKET_INFO_FIELDS]
+        ).outerjoin(models.Ticket, models.Ticket.load_id == models.Job.load_id)
+    if "dw" in includes:
+        dw_fields = [getattr(models.DWJobData, f) for f in DW_INFO_FIELDS]
+        # DISTINCT ON (load_id) + เรียงทุก field → แถวที่เลือกคงที่ (ETag ของ include=dw hash จาก body)
+        dw = (
+            select(models.DWJobData.load_id, *dw_fields)
+            .distinct(models.DWJobData.load_id)
+            .order_by(models.DWJobData.load_id, *[c.asc().nulls_last() for c in dw_fields])
+            .subquery("dw")
+        )
+        stmt = stmt.add_columns(
+            *[dw.c[f].label(f"dw__{f}") for f in DW_INFO_FIELDS]
+        ).outerjoin(dw, dw.c.load_id == models.Job.load_id)
+    if "vehicle" in includes:
+        stmt = stmt.add_columns(
+            *[getattr(models.VehicleCurrentData, f).label(f"vehicle__{f}") for f in VEHICLE_INFO_FIELDS]
+        ).outerjoin(
+            models.VehicleCurrentData,
+            models.VehicleCurrentData.plate_master == models.Job.h_plate,
+        )
+    return stmt
+
+
+def _job_sideloads(row, includes: set) -> dict:
+    m = row._mapping
+    out = {}
+
+    # Add driver info
+    if "driver" in includes:
+        ts = m["driver__timestamp_login"]
+        out["driver_info"] = {
+            "latlng_current": m["driver__latlng_current"],
+            "timestamp_login": (
+                ts.astimezone(ZoneInfo("Asia/Bangkok")).isoformat() if ts else None
             ),
         }
+
+    # Add ticket info
+    if "ticket" in includes:
+        out["ticket_info"] = {f: m[f"ticket__{f}"] for f in TICKET_INFO_FIELDS}
+
+    # DWJobData info
+    if "dw" in includes:
+        out["dw_jobdata_info"] = {f: m[f"dw__{f}"] for f in DW_INFO_FIELDS}
+
+    # ---- Vehicle Info ----
+    if "vehicle" in includes:
+        vehicle_info = {f: m[f"vehicle__{f}"] for f in VEHICLE_INFO_FIELDS}
+        if vehicle_info["gps_updated_at"]:
+            vehicle_info["gps_updated_at"] = vehicle_info["gps_updated_at"].isoformat()
+        out["vehicle_info"] = vehicle_info
+
+    return out
+
+
+def _jobs_version(db: Session, current_user, driver_name, includes: set) -> tuple:
+    """
+    version signal ของ /jobs ที่อ่านแค่ปลาย index (ไม่ scan ตาม filter ทุกหน้า / ทุก poll)
+    - max(change_xid) ของ job / tombstone ใน scope คนขับ (ทั้ง table ถ้า admin ไม่กรองคนขับ)
+      ทุก INSERT / UPDATE (ticket อัปเดตจะขยับ job ด้วย) และการลบได้ xid ใหม่
+    - xid ที่ยังไม่ commit และไม่เกิน max: commit ทีหลังได้โดย max ไม่ขยับ
+      ใส่ไว้ด้วย พอ commit แล้ว version จะเปลี่ยน
+    - driver / vehicle ที่ join มาใช้ max timestamp ของตารางนั้น
+    ทุกค่าอ่านใน statement เดียว (snapshot เดียวกัน)
+    """
+    job_xid = (
+        select(func.max(models.Job.change_xid))
+        .where(*_changes_scope(models.Job.driver_name, current_user, driver_name))
+        .scalar_subquery()
+    )
+    tomb_xid = (
+        select(func.max(models.JobTombstone.change_xid))
+        .where(*_changes_scope(models.JobTombstone.driver_name, current_user, driver_name))
+        .scalar_subquery()
+    )
+    xip = cast(cast(func.pg_snapshot_xip(func.pg_current_snapshot()).column_valued("xip"), Text), BigInteger)
+    in_progress = (
+        select(func.array_agg(aggregate_order_by(xip, xip)))
+        .where(xip <= func.greatest(job_xid, tomb_xid))
+        .scalar_subquery()
+    )
+
+    cols = [job_xid, tomb_xid, in_progress]
+    if "driver" in includes:
+        cols.append(select(func.max(models.User.timestamp_login)).scalar_subquery())
+    if "vehicle" in includes:
+        cols.append(select(func.max(models.VehicleCurrentData.updated_at)).scalar_subquery())
+    return tuple(db.execute(select(*cols)).one())
+
+
+@app.get("/jobs")
+async def get_jobs(
+    request: Request,
+    current_user: auth.Principal = Depends(auth.get_read_user_async),
+
+    load_id: Optional[List[str]] = Query(None),
+    h_plate: Optional[List[str]] = Query(None),
+    t_plate: Optional[List[str]] = Query(None),
+    locat_recive: Optional[List[str]] = Query(None),
+    date_recive: Optional[List[datetime]] = Query(None),
+    locat_deliver: Optional[List[str]] = Query(None),
+    date_deliver: Optional[List[datetime]] = Query(None),
+    driver_name: Optional[List[str]] = Query(None),
+    status: Optional[List[str]] = Query(None),
+    date_plan_start: Optional[date] = Query(None),
+    date_plan_end: Optional[date] = Query(None),
+
+    # pagination (ไม่ส่ง limit: admin ได้หน้าละ JOBS_ADMIN_DEFAULT_LIMIT, คนขับได้ทั้งหมด)
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[str] = Query(None, description="next_cursor จากหน้าก่อนหน้า"),
+    all_rows: bool = Query(False, alias="all", description="admin: ไม่แบ่งหน้า (อ่านทั้ง table ที่ filter แล้ว)"),
+
+    # ข้อมูลประกอบ (ไม่ส่ง = ทั้งหมด, ส่งค่าว่าง = ไม่ join เลย)
+    include: Optional[str] = Query(None, description="driver,ticket,dw,vehicle"),
+    # เลือกเฉพาะคอลัมน์ของ job ที่ต้องการ (ไม่ส่ง = ทุกคอลัมน์)
+    fields: Optional[str] = Query(None, description="เช่น load_id,status,date_plan"),
+    if_none_match: Optional[str] = Header(None),
+):
+    # admin ดูได้ทั้ง table → แบ่งหน้าเป็นค่าเริ่มต้น (all=true = ไม่แบ่ง), คนขับเห็นแค่ช่วง 7 วันของตัวเอง
+    page_size = limit
+    if page_size is None and current_user.role == "admin" and not all_rows:
+        page_size = JOBS_ADMIN_DEFAULT_LIMIT
+
+    def work(db: Session):
+        includes = _parse_job_includes(include)
+        field_names = _parse_job_fields(fields)
+        conditions = _job_filters(
+            current_user,
+            load_id=load_id, h_plate=h_plate, t_plate=t_plate,
+            locat_recive=locat_recive, date_recive=date_recive,
+            locat_deliver=locat_deliver, date_deliver=date_deliver,
+            driver_name=driver_name, status=status,
+            date_plan_start=date_plan_start, date_plan_end=date_plan_end,
+        )
+
+        # === Sorting (ทำใน SQL) + keyset pagination ===
+        today = date.today()
+        after = None
+        if cursor:
+            after = _decode_job_cursor(cursor)
+            today = after["today"]
+
+        # === ETag: เช็ค version ก่อนสร้าง body ===
+        # dw_jobdata เป็น view ไม่มี version signal → include=dw ใช้ hash ของ body แทน (ดูด้านล่าง)
+        etag = None
+        if "dw" not in includes:
+            etag = _etag(
+                "jobs",
+                _jobs_version(db, current_user, driver_name, includes),
+                current_user.username,
+                current_user.role,
+                today,
+                request.url.query,
+            )
+            if _etag_matches(if_none_match, etag):
+                return _not_modified(etag)
+
+        stmt = _job_page_query(
+            _job_columns(field_names), conditions, includes, today, after, page_size
+        )
+
+        rows = db.execute(stmt).all()
+
+        next_cursor = None
+        if page_size and len(rows) > page_size:
+            rows = rows[:page_size]
+            next_cursor = _encode_job_cursor(rows[-1], today)
+
+        job_dicts = []
+        for row in rows:
+            m = row._mapping
+            job_dict = {f: m[f] for f in field_names}
+            job_dict.update(_job_sideloads(row, includes))
+            job_dicts.append(job_dict)
+
+        body = orjson.dumps({
+            "role": current_user.role,
+            "jobs": job_dicts,
+            "has_more": next_cursor is not None,
+            "next_cursor": next_cursor,
+        }, default=str)
+        if etag is None:
+            etag = _etag("jobs", hashlib.sha1(body).hexdigest())
+            if _etag_matches(if_none_match, etag):
+                return _not_modified(etag)
+        return Response(body, media_type="application/json", headers={"ETag": etag})
+
+    return await database.run_db(work)
+
+
+def _changes_scope(driver_col, current_user, driver_name):
+    if current_user.role != "admin":
+        return [driver_col == current_user.username]
+    if driver_name:
+        return [driver_col.in_(driver_name)]
+    return []
+
+
+def _begin_repeatable_read(db: Session):
+    """
+    เริ่ม transaction ใหม่แบบ REPEATABLE READ (ทุก statement เห็น snapshot เดียวกัน)
+    ปิด transaction ที่ dependency ตรวจสิทธิ์เปิดค้างไว้ก่อน
+    """
+    db.commit()
+    db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+
+
+def _snapshot_xmin(db: Session) -> int:
+    """
+    xid ต่ำสุดที่ยังไม่ commit ใน snapshot ปัจจุบัน
+    ทุกการเขียนที่ snapshot นี้มองไม่เห็น (ยังไม่ commit หรือเริ่มทีหลัง) มี xid >= ค่านี้
+    """
+    return db.execute(
+        select(cast(cast(func.pg_snapshot_xmin(func.pg_current_snapshot()), Text), BigInteger))
+    ).scalar()
+
+
+def _changes_after(xid_col, id_col, watermark: int, key):
+    """แถวที่เขียนโดย transaction ที่ snapshot ก่อนหน้ามองไม่เห็น ถัดจาก key ของหน้านี้"""
+    conditions = [xid_col >= watermark]
+    if key:
+        conditions.append(tuple_(xid_col, id_col) > tuple(key))
+    return and_(*conditions)
+
+
+def _decode_changes_cursor(cursor: str) -> dict:
+    payload = _decode_cursor(cursor)
+    try:
+        keys = {"w": int(payload["w"]), "n": payload.get("n"), "s": payload.get("s")}
+        if keys["n"] is not None:
+            keys["n"] = int(keys["n"])
+        if keys["s"] is not None:
+            keys["s"] = str(keys["s"])
+        for k in ("j", "d"):
+            key = payload.get(k)
+            if key is not None:
+                key = [int(key[0]), str(key[1])]
+            keys[k] = key
+        return keys
+    except (KeyError, IndexError, TypeError, ValueError):
+        # รวม cursor แบบเดิม (updated_at) → client เริ่ม snapshot ใหม่
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@app.get("/jobs/changes")
+def get_job_changes(
+    db: Session = Depends(get_db),
+    current_user: auth.Principal = Depends(auth.get_read_user),
+
+    since: Optional[str] = Query(None, description="cursor จากการเรียกครั้งก่อน (ไม่ส่ง = snapshot)"),
+    limit: int = Query(500, ge=1, le=5000),
+    driver_name: Optional[List[str]] = Query(None, description="admin เท่านั้น"),
+    date_plan_start: Optional[date] = Query(None, description="ใช้กับ snapshot"),
+    date_plan_end: Optional[date] = Query(None, description="ใช้กับ snapshot"),
+    include: Optional[str] = Query(None, description="driver,ticket,dw,vehicle"),
+    fields: Optional[str] = Query(None, description="เช่น load_id,status,date_plan"),
+):
+    """
+    🔄 Delta sync สำหรับแอปคนขับ
+    - ไม่ส่ง `since` → snapshot ชุดเดียวกับ GET /jobs ทีละ `limit` แถว (เรียง load_id)
+      หน้าถัดไปส่ง `since` = cursor พร้อม filter เดิม (`snapshot` = true จนกว่าจะครบ)
+    - ส่ง `since` → เฉพาะ job ที่สร้าง/แก้ไข (รวม ticket) และ job ที่ถูกลบ หลัง cursor
+    ให้ client ลบตาม `deleted` ก่อนแล้วค่อย upsert ตาม `jobs`
+    เรียกซ้ำด้วย `cursor` ใหม่จนกว่า `has_more` = false
+
+    cursor ใช้ xid ที่ DB ตั้งให้ (change_xid) ไม่ใช่ updated_at:
+    transaction ที่ commit ช้ากว่า poll (import / bulk update) จะถูกส่งในรอบถัดไปเสมอ
+    อาจได้ job ซ้ำกับรอบก่อนได้ (upsert ซ้ำไม่มีผล)
+    snapshot หลายหน้าอ่านคนละ transaction กันได้: ทุกการเขียนหลังหน้าแรกมี xid >= w
+    จึงตามมาใน delta ถัดไปอยู่แล้ว
+    """
+    includes = _parse_job_includes(include)
+    field_names = _parse_job_fields(fields)
+
+    job_scope = _changes_scope(models.Job.driver_name, current_user, driver_name)
+    tomb_scope = _changes_scope(models.JobTombstone.driver_name, current_user, driver_name)
+
+    stmt = (
+        select(
+            *_job_columns(field_names),
+            models.Job.change_xid.label("sync_xid"),
+            models.Job.load_id.label("sync_load_id"),
+        )
+        .select_from(models.Job)
+    )
+    stmt = _with_job_sideloads(stmt, includes)
+
+    # watermark กับแถวที่อ่านต้องมาจาก snapshot เดียวกัน
+    _begin_repeatable_read(db)
+
+    cursor = _decode_changes_cursor(since) if since else None
+    snapshot = cursor is None or cursor["s"] is not None
+    if snapshot:
+        # === Snapshot (ทีละหน้าตาม load_id) ===
+        if cursor is None:
+            cursor = {"w": _snapshot_xmin(db), "n": None, "j": None, "d": None, "s": None}
+        conditions = _job_filters(
+            current_user,
+            driver_name=driver_name,
+            date_plan_start=date_plan_start,
+            date_plan_end=date_plan_end,
+        )
+        if cursor["s"] is not None:
+            conditions.append(models.Job.load_id > cursor["s"])
+        rows = db.execute(
+            stmt.where(*conditions).order_by(models.Job.load_id).limit(limit + 1)
+        ).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        # ครบแล้ว → cursor ถัดไปเริ่ม delta ที่ w ของหน้าแรก
+        cursor["s"] = rows[-1].sync_load_id if has_more else None
+        deleted = []
+    else:
+        # === Delta ===
+        # รอบหนึ่งอ่านทุกแถวที่ xid >= w (ทีละหน้า) แล้วรอบถัดไปเริ่มที่ n = xmin ตอนหน้าแรก
+        if cursor["n"] is None:
+            cursor["n"] = _snapshot_xmin(db)
+
+        rows = db.execute(
+            stmt.where(
+                *job_scope,
+                _changes_after(models.Job.change_xid, models.Job.load_id, cursor["w"], cursor["j"]),
+            )
+            .order_by(models.Job.change_xid, models.Job.load_id)
+            .limit(limit + 1)
+        ).all()
+
+        # tombstone ส่งเฉพาะเมื่อ job ไม่อยู่ใน scope แล้วจริงๆ
+        # (ย้ายคนขับ: ส่งให้คนขับเดิม ไม่ส่งให้ admin หรือ scope ที่ยังเห็น job นี้)
+        current = aliased(models.Job)
+        still_visible = (
+            select(current.load_id)
+            .where(
+                current.load_id == models.JobTombstone.load_id,
+                *_changes_scope(current.driver_name, current_user, driver_name),
+            )
+            .exists()
+        )
+        tombstones = db.execute(
+            select(
+                models.JobTombstone.load_id,
+                models.JobTombstone.deleted_at,
+                models.JobTombstone.change_xid,
+            )
+            .where(
+                *tomb_scope,
+                _changes_after(
+                    models.JobTombstone.change_xid, models.JobTombstone.load_id,
+                    cursor["w"], cursor["d"],
+                ),
+                ~still_visible,
+            )
+            .order_by(models.JobTombstone.change_xid, models.JobTombstone.load_id)
+            .limit(limit + 1)
+        ).all()
+
+        has_more = len(rows) > limit or len(tombstones) > limit
+        rows = rows[:limit]
+        tombstones = tombstones[:limit]
+
+        if has_more:
+            if rows:
+                cursor["j"] = [rows[-1].sync_xid, rows[-1].sync_load_id]
+            if tombstones:
+                cursor["d"] = [tombstones[-1].change_xid, tombstones[-1].load_id]
+        else:
+            cursor = {"w": cursor["n"], "n": None, "j": None, "d": None, "s": None}
+        deleted = [{"load_id": t.load_id, "deleted_at": t.deleted_at} for t in tombstones]
+    db.commit()
+
+    job_dicts = []
+    for row in rows:
+        m = row._mapping
+        job_dict = {f: m[f] for f in field_names}
+        job_dict.update(_job_sideloads(row, includes))
         job_dicts.append(job_dict)
 
-    return {
+    return _json_response({
         "role": current_user.role,
+        "snapshot": snapshot,
         "jobs": job_dicts,
-    }
+        "deleted": deleted,
+        "cursor": _encode_cursor(cursor),
+        "has_more": has_more,
+    })
     
+# ความถี่ของ heartbeat ให้ proxy ไม่ตัด connection ที่เงียบ
+STREAM_HEARTBEAT_SECONDS = 15
+
+
+def _resolve_user(token: str):
+    db = SessionLocal()
+    try:
+        return auth.get_current_user(token=token, db=db)
+    finally:
+        db.close()
+
+
+def _job_event_filter(current_user, driver_name: Optional[List[str]]):
+    """filter ตาม role / driver_name แบบเดียวกับ GET /jobs"""
+    if current_user.role != "admin":
+        username = current_user.username
+        return lambda event: event.get("driver_name") == username
+    if driver_name:
+        wanted = set(driver_name)
+        return lambda event: event.get("driver_name") in wanted
+    return lambda event: True
+
+
+def _sse(event_type: str, data) -> str:
+    return f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+@app.get("/jobs/stream")
+async def stream_job_events(
+    request: Request,
+    token: Optional[str] = Depends(auth.oauth2_scheme_optional),
+    access_token: Optional[str] = Query(None, description="ใช้แทน header Authorization (EventSource ของ browser ตั้ง header ไม่ได้)"),
+    driver_name: Optional[List[str]] = Query(None, description="admin เท่านั้น"),
+):
+    """
+    📡 Server-Sent Events ของสถานะ job / milestone ของ ticket
+    - คนขับได้เฉพาะงานของตัวเอง, admin ได้ทั้งหมด (หรือเฉพาะ driver_name ที่เลือก)
+    - event `job_removed` = งานถูกย้ายไปคนขับอื่น (ส่งให้คนขับเดิม) ให้ลบออกจากรายการ
+    - event `resync` = ส่งไม่ทัน ให้ดึง /jobs/changes ใหม่
+    - token: header `Authorization: Bearer` หรือ `?access_token=` สำหรับ `new EventSource(url)`
+      (token ใน URL ไปอยู่ใน access log ของ proxy ได้ ใช้ header เมื่อ client ตั้งได้)
+    """
+    token = token or access_token
+    if not token:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    # auth ด้วย session สั้นๆ (ไม่ถือ connection DB ค้างไว้ตลอด stream)
+    current_user = await run_in_threadpool(_resolve_user, token)
+    sub = events.broker.subscribe(_job_event_filter(current_user, driver_name))
+
+    async def event_stream():
+        try:
+            yield _sse("ready", {"role": current_user.role})
+            while not await request.is_disconnected():
+                if sub.overflowed:
+                    sub.overflowed = False
+                    yield _sse("resync", {"reason": "subscriber queue overflow"})
+                try:
+                    event = await asyncio.wait_for(sub.queue.get(), STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                yield _sse(event.get("type", "message"), event)
+        finally:
+            events.broker.unsubscribe(sub)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 ALLOWED_GROUP_FIELDS = {
     "start_datetime",
     "origin_datetime",
@@ -361,174 +980,221 @@ def _is_group_wide_update(update_fields: dict) -> bool:
         all(k in ALLOWED_GROUP_FIELDS for k in update_fields.keys())
     )
 
-def compute_status(ticket):
-    # เช็คสถานะจากล่าสุด -> ย้อนหลัง
-    if ticket.complete_datetime:        return "จัดส่งแล้ว (POD)"
-    if ticket.end_unload_datetime:      return "ลงสินค้าเสร็จ"
-    if ticket.start_unload_datetime:    return "เริ่มลงสินค้า"
-    if ticket.desination_datetime:      return "ถึงปลายทาง"   # ชื่อฟิลด์สะกดตามโมเดลเดิม
-    if ticket.intransit_datetime:       return "เริ่มขนส่ง"
-    if ticket.end_recive_datetime:      return "ขึ้นสินค้าเสร็จ"
-    if ticket.start_recive_datetime:    return "เริ่มขึ้นสินค้า"
-    if ticket.origin_datetime:          return "ถึงต้นทาง"
-    if ticket.start_datetime:           return "รับงาน"
-    return "พร้อมรับงาน"
-
-def compute_status_neo(ticket):
-    # เช็คสถานะจากล่าสุด -> ย้อนหลัง
-    if ticket.complete_datetime:        return "จัดส่งแล้ว (POD)"
-    if ticket.docs_returned_datetime:   return "ได้รับเอกสารคืน"
-    if ticket.end_unload_datetime:      return "ลงสินค้าเสร็จ"
-    if ticket.start_unload_datetime:    return "เริ่มลงสินค้า"
-    if ticket.docs_submitted_datetime:  return "ยื่นเอกสาร"
-    if ticket.desination_datetime:      return "ถึงปลายทาง"   # ชื่อฟิลด์สะกดตามโมเดลเดิม
-    if ticket.intransit_datetime:       return "เริ่มขนส่ง"
-    if ticket.end_recive_datetime:      return "ขึ้นสินค้าเสร็จ"
-    if ticket.start_recive_datetime:    return "เริ่มขึ้นสินค้า"
-    if ticket.origin_datetime:          return "ถึงต้นทาง"
-    if ticket.start_datetime:           return "รับงาน"
-    return "พร้อมรับงาน"
-
-def compute_status(ticket):
-    # เช็คสถานะจากล่าสุด -> ย้อนหลัง
-    if ticket.complete_datetime:        return "จัดส่งแล้ว (POD)"
-    if ticket.end_unload_datetime:      return "ลงสินค้าเสร็จ"
-    if ticket.start_unload_datetime:    return "เริ่มลงสินค้า"
-    if ticket.desination_datetime:      return "ถึงปลายทาง"   # ชื่อฟิลด์สะกดตามโมเดลเดิม
-    if ticket.intransit_datetime:       return "เริ่มขนส่ง"
-    if ticket.end_recive_datetime:      return "ขึ้นสินค้าเสร็จ"
-    if ticket.start_recive_datetime:    return "เริ่มขึ้นสินค้า"
-    if ticket.origin_datetime:          return "ถึงต้นทาง"
-    if ticket.start_datetime:           return "รับงาน"
-    return "พร้อมรับงาน"
-
-
-def compute_status_neo(ticket):
-    # เช็คสถานะจากล่าสุด -> ย้อนหลัง
-    if ticket.complete_datetime:        return "จัดส่งแล้ว (POD)"
-    if ticket.docs_returned_datetime:   return "ได้รับเอกสารคืน"
-    if ticket.end_unload_datetime:      return "ลงสินค้าเสร็จ"
-    if ticket.start_unload_datetime:    return "เริ่มลงสินค้า"
-    if ticket.docs_submitted_datetime:  return "ยื่นเอกสาร"
-    if ticket.desination_datetime:      return "ถึงปลายทาง"   # ชื่อฟิลด์สะกดตามโมเดลเดิม
-    if ticket.intransit_datetime:       return "เริ่มขนส่ง"
-    if ticket.end_recive_datetime:      return "ขึ้นสินค้าเสร็จ"
-    if ticket.start_recive_datetime:    return "เริ่มขึ้นสินค้า"
-    if ticket.origin_datetime:          return "ถึงต้นทาง"
-    if ticket.start_datetime:           return "รับงาน"
-    return "พร้อมรับงาน"
-
-
-# 🗺️ Mapping locat_recive → compute function
-STATUS_FUNC_MAP = {
-    "บริษัท นีโอ แฟคทอรี่ จำกัด": compute_status_neo,
-    # สามารถเพิ่ม mapping บริษัทอื่นได้ที่นี่
-}
-
-
-@app.post("/job-tickets")
-def create_or_update_ticket(
-    data: TicketUpdate = Body(...),
-    apply_to_group: bool = Query(True),
+@app.post("/jobs/status/recompute")
+def recompute_job_status(
+    date_plan_start: date = Query(...),
+    date_plan_end: date = Query(...),
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: auth.Principal = Depends(auth.get_current_user),
 ):
-    anchor = db.query(models.Job).filter(models.Job.load_id == data.load_id).first()
-    if not anchor:
-        raise HTTPException(status_code=404, detail="load_id not found in jobdata")
+    """
+    🔁 (admin) คำนวณ Job.status ใหม่จาก ticket ทั้งช่วง date_plan ใน UPDATE เดียว
+    ใช้หลังเพิ่ม/แก้ตาราง milestone ของบริษัทใน status_engine
+    """
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
 
-    # สร้าง dict ฟิลด์ที่จะอัปเดต (ไม่รวม load_id) และทำความสะอาดค่าว่าง
-    def _clean_value(v):
-        # Convert empty string → None
-        if v == "" or v is None:
-            return None
-        return v
+    job_table = models.Job.__table__
+    ticket_table = models.Ticket.__table__
+    new_status = status_engine.status_case(ticket_table, job_table.c.locat_recive)
+    now = datetime.now()
 
-    raw_update_fields = {
-        k: _clean_value(v)
-        for k, v in data.dict(exclude_unset=True).items()
-        if k != "load_id"
-    }
-    update_fields = raw_update_fields
+    changed = db.execute(
+        job_table.update()
+        .where(
+            job_table.c.load_id == ticket_table.c.load_id,
+            job_table.c.date_plan >= date_plan_start,
+            job_table.c.date_plan <= date_plan_end,
+            job_table.c.status.is_distinct_from(new_status),
+        )
+        .values(status=new_status, updated_at=now, updated_by=current_user.username)
+        .returning(job_table.c.load_id, job_table.c.driver_name, job_table.c.status)
+    ).all()
+    db.commit()
 
-    # ตัดสินใจว่าจะอัปเดตทั้งกลุ่มหรือไม่
-    group_mode = (
-        apply_to_group
-        and getattr(anchor, "group_key", None)
-        and _is_group_wide_update(update_fields)
-    )
+    events.broker.publish_many([
+        {
+            "type": "job_status",
+            "load_id": load_id,
+            "driver_name": driver_name,
+            "status": job_status,
+            "updated_by": current_user.username,
+            "updated_at": now.isoformat(),
+        }
+        for load_id, driver_name, job_status in changed
+    ])
 
-    if group_mode:
-        group_load_ids = [
-            r[0]
-            for r in db.query(models.Job.load_id)
-                      .filter(models.Job.group_key == anchor.group_key)
-                      .all()
-        ]
-    else:
-        group_load_ids = [data.load_id]
+    return {
+        "message": f"✅ Recomputed status of {len(changed)} job(s)",
+        "updated": len(changed),
+    }
 
-    affected = []
-    try:
-        for lid in group_load_ids:
-            ticket = db.query(models.Ticket).filter(models.Ticket.load_id == lid).first()
-            job = db.query(models.Job).filter(models.Job.load_id == lid).first()
 
-            if ticket:
-                for f, val in update_fields.items():
-                    setattr(ticket, f, val)
-            else:
-                payload = {**update_fields, "load_id": lid}
-                ticket = models.Ticket(**payload)
-                db.add(ticket)
+def _publish_events(status_events: list):
+    events.broker.publish_many(status_events)
 
-            db.flush()  # ให้ ticket ได้ค่าล่าสุดก่อนคำนวณสถานะ
 
-            # --- เลือกฟังก์ชันสถานะตามบริษัท ---
-            if job and job.locat_recive in STATUS_FUNC_MAP:
-                status_func = STATUS_FUNC_MAP[job.locat_recive]
-            else:
-                status_func = compute_status
+@app.post("/job-tickets")
+async def create_or_update_ticket(
+    data: TicketUpdate = Body(...),
+    apply_to_group: bool = Query(True),
+    current_user: auth.Principal = Depends(auth.get_current_user_async),
+):
+    def work(db: Session):
+        anchor = db.query(models.Job).filter(models.Job.load_id == data.load_id).first()
+        if not anchor:
+            raise HTTPException(status_code=404, detail="load_id not found in jobdata")
+
+        # สร้าง dict ฟิลด์ที่จะอัปเดต (ไม่รวม load_id) และทำความสะอาดค่าว่าง
+        def _clean_value(v):
+            # Convert empty string → None
+            if v == "" or v is None:
+                return None
+            return v
+
+        raw_update_fields = {
+            k: _clean_value(v)
+            for k, v in data.dict(exclude_unset=True).items()
+            if k != "load_id"
+        }
+        update_fields = raw_update_fields
 
-            status = status_func(ticket)
+        # ตัดสินใจว่าจะอัปเดตทั้งกลุ่มหรือไม่
+        group_mode = (
+            apply_to_group
+            and anchor.group_key_uuid is not None
+            and _is_group_wide_update(update_fields)
+        )
 
-            if job and status:
-                job.status = status
+        # 1) job ทั้งกลุ่ม (group_key_uuid มี index) — query เดียว
+        if group_mode:
+            group_jobs = db.execute(
+                select(models.Job.load_id, models.Job.locat_recive, models.Job.driver_name)
+                .where(models.Job.group_key_uuid == anchor.group_key_uuid)
+            ).all()
+        else:
+            group_jobs = [(anchor.load_id, anchor.locat_recive, anchor.driver_name)]
+        group_load_ids = [j[0] for j in group_jobs]
+
+        ticket_table = models.Ticket.__table__
+        now = datetime.now()
+        affected = []
+        status_events = []
+        try:
+            # 2) ticket ทั้งกลุ่ม — query เดียว
+            tickets = {
+                row.load_id: row._asdict()
+                for row in db.execute(
+                    select(*ticket_table.columns).where(ticket_table.c.load_id.in_(group_load_ids))
+                )
+            }
+
+            # 3) เขียน ticket กลับแบบ bulk (ทุกแถวได้ค่าเดียวกัน)
+            existing = [lid for lid in group_load_ids if lid in tickets]
+            missing = [lid for lid in group_load_ids if lid not in tickets]
+            if existing and update_fields:
+                db.execute(
+                    ticket_table.update()
+                    .where(ticket_table.c.load_id.in_(existing))
+                    .values(update_fields)
+                )
+            if missing:
+                db.execute(ticket_table.insert(), [{**update_fields, "load_id": lid} for lid in missing])
+
+            # 4) คำนวณสถานะในหน่วยความจำจาก ticket หลังอัปเดต
+            blank_ticket = {c.name: None for c in ticket_table.columns}
+            new_status = {}
+            for lid, locat_recive, driver_name in group_jobs:
+                merged = {**blank_ticket, **tickets.get(lid, {}), **update_fields}
+
+                # --- ตาราง milestone ตามบริษัท ---
+                status = status_engine.compute_status(merged, locat_recive)
+                new_status[lid] = status
+
+                affected.append({"load_id": lid, "status": status})
+                status_events.append({
+                    "type": "job_status",
+                    "load_id": lid,
+                    "driver_name": driver_name,
+                    "status": status,
+                    "ticket": update_fields,
+                    "updated_by": current_user.username,
+                    "updated_at": now.isoformat(),
+                })
+
+            # 5) อัปเดตสถานะ job ทั้งกลุ่มใน statement เดียว
+            #    (ขยับ updated_at ให้ /jobs/changes เห็นการเปลี่ยนแปลงของ ticket ด้วย)
+            db.execute(
+                models.Job.__table__.update()
+                .where(models.Job.load_id.in_(group_load_ids))
+                .values(
+                    status=case(new_status, value=models.Job.load_id),
+                    updated_at=now,
+                    updated_by=current_user.username,
+                )
+            )
 
-            affected.append({"load_id": lid, "status": status})
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
 
-        db.commit()
-    except Exception:
-        db.rollback()
-        raise
+        return status_events, {
+            "message": "✅ Tickets updated" if len(affected) > 1 else "✅ Ticket updated",
+            "apply_to_group": bool(group_mode),
+            "group_size": len(affected),
+            "affected": affected,
+        }
+
+    status_events, result = await database.run_db(work)
+    # publish นอก run_db: backend postgres ใช้ connection sync ของตัวเอง
+    await run_in_threadpool(_publish_events, status_events)
+    return result
 
-    return {
-        "message": "✅ Tickets updated" if len(affected) > 1 else "✅ Ticket updated",
-        "apply_to_group": bool(group_mode),
-        "group_size": len(affected),
-        "affected": affected,
-    }
 @app.get("/job-tickets")
-def get_job_tickets(
+async def get_job_tickets(
     load_id: Optional[str] = Query(None),
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    fields: Optional[str] = Query(None, description="คอลัมน์ของ job ที่ต้องการ เช่น load_id,status"),
+    current_user: auth.Principal = Depends(auth.get_read_user_async)
 ):
-    if not load_id:
-        raise HTTPException(status_code=400, detail="Missing load_id")
-
-    job = db.query(models.Job).filter(models.Job.load_id == load_id).first()
-    if not job:
-        return {"message": f"No job found with load_id = {load_id}"}
+    def work(db: Session):
+        if not load_id:
+            raise HTTPException(status_code=400, detail="Missing load_id")
+
+        field_names = _parse_job_fields(fields)
+        ticket_cols = models.Ticket.__table__.columns
+        pallet_cols = models.Palletdata.__table__.columns
+
+        # job + ticket + palletdata ใน query เดียว
+        row = db.execute(
+            select(
+                *_job_columns(field_names),
+                *[c.label(f"ticket__{c.name}") for c in ticket_cols],
+                *[c.label(f"palletdata__{c.name}") for c in pallet_cols],
+            )
+            .select_from(models.Job)
+            .outerjoin(models.Ticket, models.Ticket.load_id == models.Job.load_id)
+            .outerjoin(models.Palletdata, models.Palletdata.load_id == models.Job.load_id)
+            .where(models.Job.load_id == load_id)
+        ).first()
+        if not row:
+            return {"message": f"No job found with load_id = {load_id}"}
+
+        m = row._mapping
+        job_dict = {f: m[f] for f in field_names}
+        job_dict["ticket"] = (
+            {c.name: m[f"ticket__{c.name}"] for c in ticket_cols}
+            if m["ticket__load_id"] is not None else None
+        )
+        job_dict["palletdata"] = (
+            {c.name: m[f"palletdata__{c.name}"] for c in pallet_cols}
+            if m["palletdata__load_id"] is not None else None
+        )
 
-    ticket = db.query(models.Ticket).filter(models.Ticket.load_id == load_id).first()
-    pallet = db.query(models.Palletdata).filter(models.Palletdata.load_id == load_id).first()  # << เพิ่มตรงนี้
+        return _json_response(job_dict)
 
-    job_dict = job.__dict__.copy()
-    job_dict["ticket"] = ticket.__dict__ if ticket else None
-    job_dict["palletdata"] = pallet.__dict__ if pallet else None   # << เพิ่มตรงนี้
+    return await database.run_db(work)
 
-    return job_dict
 
 
 
@@ -536,7 +1202,7 @@ def get_job_tickets(
 def create_or_update_palletdata(
     data: PalletDataUpdate = Body(...),
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     # ตรวจสอบว่ามี job นี้หรือไม่ (optionally)
     job = db.query(models.Job).filter(models.Job.load_id == data.load_id).first()
@@ -572,13 +1238,12 @@ def model_to_dict(obj):
         return None
     return {c.name: getattr(obj, c.name) for c in obj.__table__.columns}
  
-from sqlalchemy import func
 
 @app.post("/jobs")
 def create_job(
     data: JobUpdateSchemaCreate = Body(...),
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     now = datetime.now()
 
@@ -587,23 +1252,8 @@ def create_job(
     if not data.date_plan:
         raise HTTPException(status_code=400, detail="date_plan is required")
 
-    # YYMMDD (เช่น 250806)
-    yymmdd = data.date_plan.strftime("%y%m%d")
-    
-    # Query หาจำนวน job ของวันเดียวกันนี้
-    jobs_count = db.query(func.count(models.Job.load_id)) \
-        .filter(models.Job.date_plan == data.date_plan).scalar()
-    # รันนัมเบอร์ใหม่ (+1 เพราะเริ่มจาก 1)
-    running = jobs_count + 1
-
-    # Padding ด้วย 0 (เช่น 001)
-    running_str = f"{running:03d}"
-
-    load_id = f"TDM-{yymmdd}-{running_str}"
-
-    # double-check กัน insert ซ้ำ (น้อยมากจะเกิด)
-    if db.query(models.Job).filter(models.Job.load_id == load_id).first():
-        raise HTTPException(status_code=400, detail="Duplicate load_id, try again")
+    # จองเลขจากตัวนับของวันนั้น (atomic, ไม่ชนกันเมื่อสร้างพร้อมกัน)
+    load_id = load_ids.allocate_load_ids(db, data.date_plan)[0]
 
     # 2. Create Job
     new_job = models.Job(
@@ -638,39 +1288,91 @@ def create_job(
 def update_jobs(
     data_list: List[JobSchemaPut] = Body(...),
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     🔁 Update multiple jobs in a single request.
     Each item must include `load_id`.
     """
     now = datetime.now()
-    updated_jobs = []
-    not_found = []
+    job_table = models.Job.__table__
 
+    # 1. รวม item ของ load_id เดียวกัน (item หลังทับ item ก่อน)
+    changes_by_id = {}
     for data in data_list:
-        load_id = data.load_id
-        job = db.query(models.Job).filter(models.Job.load_id == load_id).first()
-
-        if not job:
-            not_found.append(load_id)
-            continue
-
-        for field, value in data.dict(exclude_unset=True).items():
-            setattr(job, field, value)
-
-        job.updated_at = now
-        job.updated_by = current_user.username
-        updated_jobs.append(job)
+        changes = data.dict(exclude_unset=True)
+        changes.pop("load_id", None)
+        changes_by_id.setdefault(data.load_id, {}).update(changes)
+
+    # 2. โหลด job ที่ต้องการทั้งหมดใน IN query เดียว
+    current_driver = dict(
+        db.execute(
+            select(models.Job.load_id, models.Job.driver_name)
+            .where(models.Job.load_id.in_([lid for lid in changes_by_id if lid is not None]))
+        ).all()
+    )
+    not_found = [lid for lid in changes_by_id if lid not in current_driver]
+
+    # ย้ายงานไปคนขับอื่น → แอปของคนขับเดิมต้องลบงานนี้ออก
+    tombstones = [
+        {
+            "load_id": lid,
+            "deleted_at": now,
+            "driver_name": current_driver[lid],
+            "deleted_by": current_user.username,
+        }
+        for lid, changes in changes_by_id.items()
+        if lid in current_driver
+        and "driver_name" in changes
+        and changes["driver_name"] != current_driver[lid]
+    ]
+    if tombstones:
+        db.execute(models.JobTombstone.__table__.insert(), tombstones)
+
+    # 3. UPDATE ... FROM (VALUES) หนึ่ง statement ต่อชุดคอลัมน์ที่เปลี่ยน
+    rows = [{**changes, "load_id": lid} for lid, changes in changes_by_id.items() if lid in current_driver]
+    updated = {}
+    for group in bulk.group_by_columns(rows).values():
+        columns = [c for c in group[0] if c != "load_id"]
+        for chunk in bulk.chunked(group):
+            stmt = bulk.update_from_values(
+                job_table, "load_id", chunk, columns,
+                extra={"updated_at": now, "updated_by": current_user.username},
+            ).returning(*job_table.columns)
+            for row in db.execute(stmt):
+                updated[row.load_id] = row._asdict()
 
     db.commit()
 
+    updated_jobs = [updated[lid] for lid in changes_by_id if lid in updated]
+    reassigned = {t["load_id"]: t["driver_name"] for t in tombstones}
+    job_events = []
     for job in updated_jobs:
-        db.refresh(job)
+        load_id = job["load_id"]
+        if load_id in reassigned:
+            # คนขับเดิมไม่ได้รับ event ของคนขับใหม่ → แจ้งให้ลบงานออก
+            job_events.append({
+                "type": "job_removed",
+                "load_id": load_id,
+                "driver_name": reassigned[load_id],
+                "new_driver_name": job["driver_name"],
+                "updated_by": current_user.username,
+                "updated_at": now.isoformat(),
+            })
+        if load_id in reassigned or "status" in changes_by_id[load_id]:
+            job_events.append({
+                "type": "job_status",
+                "load_id": load_id,
+                "driver_name": job["driver_name"],
+                "status": job["status"],
+                "updated_by": current_user.username,
+                "updated_at": now.isoformat(),
+            })
+    events.broker.publish_many(job_events)
 
     return {
         "message": f"✅ Updated {len(updated_jobs)} job(s) successfully",
-        "updated_jobs": [model_to_dict(j) for j in updated_jobs],
+        "updated_jobs": updated_jobs,
         "not_found": not_found
     }
 
@@ -678,7 +1380,7 @@ def update_jobs(
 def delete_job(
     load_id: str = Query(...),
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     job = db.query(models.Job).filter(models.Job.load_id == load_id).first()
     if not job:
@@ -694,141 +1396,351 @@ def delete_job(
     if pallet:
         db.delete(pallet)
 
-    # 3. ลบ Job
+    # 3. ลบ Job (+ tombstone ให้ /jobs/changes)
+    db.add(models.JobTombstone(
+        load_id=job.load_id,
+        deleted_at=datetime.now(),
+        driver_name=job.driver_name,
+        deleted_by=current_user.username,
+    ))
     db.delete(job)
     db.commit()
     return {"message": "✅ Job, Ticket, Palletdata deleted"}
 
-from sqlalchemy import func
-from typing import List
+@app.post("/jobs/bulk-delete")
+def delete_jobs_bulk(
+    data: JobBulkDeleteRequest = Body(...),
+    db: Session = Depends(get_db),
+    current_user: auth.Principal = Depends(auth.get_current_user)
+):
+    """
+    🗑️ ลบ job หลายรายการ (ตาม load_ids และ/หรือช่วง date_plan)
+    ลบ ticketdata / palletdata / jobdata ตารางละ 1 statement ใน transaction เดียว
+    ส่งทั้งคู่ = ลบเฉพาะ load_ids ที่อยู่ในช่วง (ที่มีอยู่แต่นอกช่วงรายงานใน outside_range)
+    """
+    conditions = []
+    if data.load_ids:
+        conditions.append(models.Job.load_id.in_(data.load_ids))
+    if data.date_plan_start and data.date_plan_end:
+        conditions.append(models.Job.date_plan >= data.date_plan_start)
+        conditions.append(models.Job.date_plan <= data.date_plan_end)
+
+    targets = select(models.Job.load_id).where(*conditions)
+    now = datetime.now()
+    try:
+        # 1. ลบ Ticket
+        db.execute(models.Ticket.__table__.delete().where(models.Ticket.load_id.in_(targets)))
+
+        # 2. ลบ Palletdata
+        db.execute(models.Palletdata.__table__.delete().where(models.Palletdata.load_id.in_(targets)))
+
+        # 3. ลบ Job (+ tombstone ให้ /jobs/changes)
+        deleted = db.execute(
+            models.Job.__table__.delete()
+            .where(*conditions)
+            .returning(models.Job.load_id, models.Job.driver_name)
+        ).all()
+        if deleted:
+            db.execute(models.JobTombstone.__table__.insert(), [
+                {
+                    "load_id": load_id,
+                    "deleted_at": now,
+                    "driver_name": driver_name,
+                    "deleted_by": current_user.username,
+                }
+                for load_id, driver_name in deleted
+            ])
+
+        deleted_ids = [load_id for load_id, _ in deleted]
+        found = set(deleted_ids)
+        not_deleted = [lid for lid in dict.fromkeys(data.load_ids or []) if lid not in found]
+        outside = set()
+        if not_deleted and data.date_plan_start:
+            # มีอยู่จริงแต่ date_plan ไม่อยู่ในช่วง → ไม่ใช่ missing
+            outside = set(db.execute(
+                select(models.Job.load_id).where(models.Job.load_id.in_(not_deleted))
+            ).scalars())
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    return {
+        "message": f"✅ Deleted {len(deleted_ids)} job(s) with Ticket, Palletdata",
+        "deleted": deleted_ids,
+        "missing": [lid for lid in not_deleted if lid not in outside],
+        "outside_range": [lid for lid in not_deleted if lid in outside],
+    }
+
+
+# ฟิลด์ที่ระบบกำหนดเองตอนสร้าง job
+JOB_CREATE_EXCLUDE = {"created_at", "updated_at", "created_by", "updated_by", "load_id"}
+
+
+def _reserve_load_ids(db: Session, items: list) -> list:
+    """จอง load_id ให้ทุก item ตามลำดับ (วันละ 1 round trip)"""
+    per_day = {}
+    for job_in in items:
+        per_day[job_in.date_plan] = per_day.get(job_in.date_plan, 0) + 1
+    reserved = {
+        day: iter(load_ids.allocate_load_ids(db, day, n))
+        for day, n in per_day.items()
+    }
+    return [next(reserved[job_in.date_plan]) for job_in in items]
+
+
+def _job_create_rows(items: list, ids: list, username: str, now: datetime) -> list:
+    return [
+        {
+            **job_in.dict(exclude=JOB_CREATE_EXCLUDE),
+            "load_id": load_id,
+            "created_by": username,
+            "created_at": now,
+            "updated_by": username,
+            "updated_at": now,
+        }
+        for job_in, load_id in zip(items, ids)
+    ]
+
 
 @app.post("/jobs/bulk")
 def create_jobs_bulk(
     data: List[JobUpdateSchemaCreate] = Body(...),
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
+    """
+    📦 สร้าง job จำนวนมากในครั้งเดียว
+    - ตรวจทั้ง batch ก่อน แล้วเขียน jobdata / ticketdata / palletdata
+      ด้วย multi-row INSERT (ไม่กี่ statement ต่อ 1,000 แถว)
+    - load_id ที่มีอยู่แล้วถูกข้าม (ON CONFLICT DO NOTHING) และรายงานเป็น duplicate รายแถว
+      แถวอื่นใน batch ยังถูกสร้าง เลขที่จองไปแล้วไม่ถูกใช้ซ้ำ (ส่งแถวนั้นใหม่จะได้เลขใหม่)
+    - results เรียงตามลำดับ input
+    """
     now = datetime.now()
-    results = []
 
-    # cache นับจำนวน job ของแต่ละวันก่อน insert ในรอบนี้
-    running_count_map = {}
-
-    for job_in in data:
+    # 1. Validate ทั้ง batch
+    results = [None] * len(data)
+    valid = []
+    for i, job_in in enumerate(data):
         if not job_in.date_plan:
-            results.append({
-                "load_id": None,
-                "status": "❌ date_plan required"
-            })
-            continue
+            results[i] = {"load_id": None, "status": "❌ date_plan required"}
+        else:
+            valid.append(i)
+
+    if valid:
+        items = [data[i] for i in valid]
+
+        # 2. จอง load_id
+        ids = _reserve_load_ids(db, items)
+
+        # 3. INSERT JOB / Ticket / Palletdata แบบ multi-row
+        rows = _job_create_rows(items, ids, current_user.username, now)
+        job_table = models.Job.__table__
+        inserted = set(db.execute(
+            pg_insert(job_table)
+            .on_conflict_do_nothing(index_elements=[job_table.c.load_id])
+            .returning(job_table.c.load_id),
+            rows,
+        ).scalars())
+        created = [{"load_id": lid} for lid in ids if lid in inserted]
+        if created:
+            for table in (models.Ticket.__table__, models.Palletdata.__table__):
+                # ticket / palletdata ค้างจาก job ที่ถูกลบไม่ครบ → ใช้ของเดิม
+                db.execute(
+                    pg_insert(table).on_conflict_do_nothing(index_elements=[table.c.load_id]),
+                    created,
+                )
+        db.commit()
 
-        yymmdd = job_in.date_plan.strftime("%y%m%d")
-        key = str(job_in.date_plan)
+        for i, load_id in zip(valid, ids):
+            outcome = "✅ created" if load_id in inserted else "❌ duplicate"
+            results[i] = {"load_id": load_id, "status": outcome}
 
-        # นับ job ที่อยู่ใน DB แล้ว + job ที่เตรียมจะ insert ในรอบนี้
-        if key not in running_count_map:
-            jobs_count = db.query(func.count(models.Job.load_id)).filter(models.Job.date_plan == job_in.date_plan).scalar()
-            running_count_map[key] = jobs_count
+    return {"results": results}
 
-        running_count_map[key] += 1
-        running_str = f"{running_count_map[key]:03d}"
-        load_id = f"TDM-{yymmdd}-{running_str}"
 
-        # Duplicate check
-        if db.query(models.Job).filter(models.Job.load_id == load_id).first():
-            results.append({
-                "load_id": load_id,
-                "status": "❌ duplicate"
-            })
-            continue
+@app.post("/jobs/import")
+def import_jobs(
+    file: UploadFile = File(..., description="แผนงาน .csv หรือ .xlsx (header = ชื่อฟิลด์ของ JobUpdateSchemaCreate)"),
+    db: Session = Depends(get_db),
+    current_user: auth.Principal = Depends(auth.get_current_user)
+):
+    """
+    📥 Import job จำนวนมากจากไฟล์ (multipart)
+    - อ่าน / validate ทีละแถว, เขียนทีละ batch ด้วย COPY (jobdata / ticketdata / palletdata)
+    - แถวที่ไม่ผ่าน validate ไม่ถูกสร้าง และรายงานใน errors พร้อมเลขแถวในไฟล์
+    - ทั้งไฟล์อยู่ใน transaction เดียว (DB error → ไม่สร้างเลยสักแถว)
+    """
+    try:
+        fmt = imports.detect_format(file.filename)
+        records = imports.iter_xlsx(file.file) if fmt == "xlsx" else imports.iter_csv(file.file)
+
+        now = datetime.now()
+        created, errors = [], []
+        job_table = models.Job.__table__
+        for batch in imports.batches(imports.validate_rows(records)):
+            items = []
+            for line_no, job_in, error in batch:
+                if error:
+                    errors.append({"row": line_no, "error": error})
+                else:
+                    items.append(job_in)
+            if not items:
+                continue
+
+            ids = _reserve_load_ids(db, items)
+            rows = _job_create_rows(items, ids, current_user.username, now)
+            bulk.copy_rows(db, job_table, list(rows[0]), rows)
+            bulk.copy_rows(db, models.Ticket.__table__, ["load_id"], [{"load_id": lid} for lid in ids])
+            bulk.copy_rows(db, models.Palletdata.__table__, ["load_id"], [{"load_id": lid} for lid in ids])
+            created.extend(ids)
+        db.commit()
+    except imports.ImportFileError as e:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=str(e))
+    except UnicodeDecodeError:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="CSV must be UTF-8")
+    except Exception:
+        db.rollback()
+        raise
 
-        # Insert JOB
-        new_job = models.Job(
-            **job_in.dict(exclude={"created_at", "updated_at", "created_by", "updated_by", "load_id"}),
-            load_id=load_id,
-            created_by=current_user.username,
-            created_at=now,
-            updated_by=current_user.username,
-            updated_at=now,
-        )
-        db.add(new_job)
+    return {
+        "message": f"✅ Imported {len(created)} job(s), {len(errors)} row(s) with errors",
+        "created": len(created),
+        "load_ids": created,
+        "errors": errors,
+    }
 
-        # Insert Ticket & Palletdata
-        db.add(models.Ticket(load_id=load_id))
-        db.add(models.Palletdata(load_id=load_id))
 
-        results.append({
-            "load_id": load_id,
-            "status": "✅ created"
-        })
+def _job_export_columns() -> list:
+    # job ทุกคอลัมน์ + ticket (prefix ticket_) แบบแบน 1 แถวต่อ load
+    return list(models.Job.__table__.columns) + [
+        c.label(f"ticket_{c.name}") for c in models.Ticket.__table__.columns if c.name != "load_id"
+    ]
 
-    db.commit()
-    return {"results": results}
 
-from typing import List, Optional
-from datetime import datetime
-from sqlalchemy.orm import Session
-from sqlalchemy import and_
-from . import models, auth
-from .schemas import PalletLogCreate, PalletLogOut
+def _stream_job_export(stmt, writer):
+    # session ของตัวเอง + server-side cursor (yield_per → stream_results)
+    db = SessionLocal()
+    try:
+        rows = db.execute(stmt.execution_options(yield_per=exports.EXPORT_BATCH_SIZE))
+        yield from writer(stmt.selected_columns, rows)
+    finally:
+        db.close()
+
+
+@app.get("/jobs/export")
+def export_jobs(
+    current_user: auth.Principal = Depends(auth.get_read_user),
+    date_plan_start: date = Query(...),
+    date_plan_end: date = Query(...),
+    format: str = Query("csv", pattern="^(csv|parquet)$"),
+):
+    """
+    📤 Export job + ticket ของช่วง date_plan เป็น CSV หรือ Parquet
+    stream ทีละ batch จาก server-side cursor (ไม่สร้างผลทั้งหมดไว้ในหน่วยความจำ)
+    """
+    if date_plan_start > date_plan_end:
+        raise HTTPException(status_code=400, detail="date_plan_start must be before date_plan_end")
+    if format == "parquet" and not exports.parquet_available():
+        raise HTTPException(status_code=400, detail="Parquet export requires pyarrow")
+
+    conditions = _job_filters(current_user, date_plan_start=date_plan_start, date_plan_end=date_plan_end)
+    stmt = (
+        select(*_job_export_columns())
+        .outerjoin(models.Ticket, models.Ticket.load_id == models.Job.load_id)
+        .where(*conditions)
+        .order_by(models.Job.date_plan, models.Job.load_id)
+    )
+
+    filename = f"jobs_{date_plan_start}_{date_plan_end}.{format}"
+    if format == "parquet":
+        writer, media_type = exports.parquet_chunks, "application/vnd.apache.parquet"
+    else:
+        writer, media_type = exports.csv_chunks, "text/csv; charset=utf-8"
+    return StreamingResponse(
+        _stream_job_export(stmt, writer),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
 
 @app.post("/palletlogs", response_model=PalletLogOut)
-def create_palletlog(
+async def create_palletlog(
     data: PalletLogCreate = Body(...),
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: auth.Principal = Depends(auth.get_current_user_async),
 ):
-    # 1. Check duplicate (timestamp + driver + plate)
-    exists = db.query(models.PalletLog).filter(
-        models.PalletLog.timestamp == data.timestamp,
-        models.PalletLog.driver_name == data.driver_name,
-        models.PalletLog.t_plate == data.t_plate,
-    ).first()
-    if exists:
-        raise HTTPException(status_code=400, detail="Duplicate palletlog for this key")
-
-    # 2. Get latest palletlog for this t_plate
-    last_log = (
-        db.query(models.PalletLog)
-        .filter(models.PalletLog.t_plate == data.t_plate)
-        .order_by(models.PalletLog.timestamp.desc())
-        .first()
-    )
+    def work(db: Session):
+        # 1. Check duplicate (timestamp + driver + plate)
+        exists = db.query(models.PalletLog).filter(
+            models.PalletLog.timestamp == database.naive_timestamp(data.timestamp),
+            models.PalletLog.driver_name == data.driver_name,
+            models.PalletLog.t_plate == data.t_plate,
+        ).first()
+        if exists:
+            raise HTTPException(status_code=400, detail="Duplicate palletlog for this key")
+
+        # 2. Insert log + ปรับยอดของ t_plate (ล็อกแถวยอดไว้จน commit)
+        try:
+            new_current, last_timestamp = pallets.apply_palletlog(db, data)
+            db.commit()
+        except IntegrityError:
+            # request อื่นเพิ่ม key เดียวกันไปก่อน
+            db.rollback()
+            raise HTTPException(status_code=400, detail="Duplicate palletlog for this key")
+        pallets.invalidate_series(data.timestamp)
+
+        # 3. Return response
+        return PalletLogOut(
+            message="Pallet log created successfully",
+            pallet_current=new_current,
+            last_timestamp=last_timestamp
+        )
 
-    # 3. Use last pallet_current (None → 0 if missing)
-    last_current = (last_log.pallet_current or 0) if last_log else 0
+    return await database.run_db(work)
 
-    # 4. Calculate new pallet_current
-    if data.pallet_type in ["รับคืน", "ยืมลค."]:
-        new_current = last_current + data.pallet_qty
-    elif data.pallet_type in ["นำฝาก", "คืนลค."]:
-        new_current = last_current - data.pallet_qty
-    else:
-        new_current = last_current
 
-    # 5. Create row (exclude pallet_current from request)
-    row = models.PalletLog(
-        **data.dict(exclude={"pallet_current"}),
-        pallet_current=new_current
-    )
 
-    db.add(row)
-    db.commit()
-    db.refresh(row)
+PALLETLOG_EXPORT_BATCH = 1000
 
-    # 6. Return response
-    return PalletLogOut(
-        message="Pallet log created successfully",
-        pallet_current=new_current,
-        last_timestamp=last_log.timestamp if last_log else None
-    )
 
-from typing import List, Optional, Union
+def _palletlog_order():
+    # ตาม composite PK ให้ cursor ไม่ซ้ำ/ไม่ข้ามแม้ timestamp ชนกัน
+    log = models.PalletLog
+    return [log.timestamp.desc(), log.driver_name.desc(), log.t_plate.desc()]
+
+
+def _encode_palletlog_cursor(row) -> str:
+    return _encode_cursor({"ts": row.timestamp.isoformat(), "d": row.driver_name, "p": row.t_plate})
+
+
+def _palletlog_after(cursor: str):
+    payload = _decode_cursor(cursor)
+    try:
+        key = (datetime.fromisoformat(payload["ts"]), str(payload["d"]), str(payload["p"]))
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    log = models.PalletLog
+    return tuple_(log.timestamp, log.driver_name, log.t_plate) < key
+
+
+def _stream_palletlogs(stmt):
+    # session ของตัวเอง: session จาก Depends ถูกปิดก่อน stream จบ
+    db = SessionLocal()
+    try:
+        rows = db.execute(stmt.execution_options(yield_per=PALLETLOG_EXPORT_BATCH)).scalars()
+        for row in rows:
+            yield orjson.dumps(PalletLogRead.model_validate(row, from_attributes=True).model_dump()) + b"\n"
+    finally:
+        db.close()
+
 
 @app.get("/palletlogs", response_model=List[PalletLogRead])
-def list_palletlogs(
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user),
+async def list_palletlogs(
+    response: Response,
+    current_user: auth.Principal = Depends(auth.get_read_user_async),
 
     # filters
     start: Optional[datetime] = Query(None, description="timestamp >= start"),
@@ -840,13 +1752,16 @@ def list_palletlogs(
 
     # pagination
     limit: int = Query(100, ge=1, le=1000),
-    offset: int = Query(0, ge=0),
+    offset: int = Query(0, ge=0, description="ใช้เมื่อไม่ส่ง cursor (หน้าลึกจะช้า)"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor จากหน้าก่อน"),
+    stream: bool = Query(False, description="ส่งทุกแถวเป็น NDJSON (export ย้อนหลังทั้งหมด)"),
 ):
-    q = db.query(models.PalletLog)
+    log = models.PalletLog
+    stmt = select(log)
 
     # --- role-based filter ---
     if current_user.role == "user":
-        q = q.filter(models.PalletLog.driver_name == current_user.username)
+        stmt = stmt.where(log.driver_name == current_user.username)
 
     # --- normalize filters ---
     def normalize(val):
@@ -863,48 +1778,124 @@ def list_palletlogs(
 
     # --- apply filters ---
     if start:
-        q = q.filter(models.PalletLog.timestamp >= start)
+        stmt = stmt.where(log.timestamp >= database.naive_timestamp(start))
     if end:
-        q = q.filter(models.PalletLog.timestamp <= end)
+        stmt = stmt.where(log.timestamp <= database.naive_timestamp(end))
     if driver_name:
-        q = q.filter(models.PalletLog.driver_name.in_(driver_name))
+        stmt = stmt.where(log.driver_name.in_(driver_name))
     if t_plate:
-        q = q.filter(models.PalletLog.t_plate.in_(t_plate))
+        stmt = stmt.where(log.t_plate.in_(t_plate))
     if pallet_type:
-        q = q.filter(models.PalletLog.pallet_type.in_(pallet_type))
+        stmt = stmt.where(log.pallet_type.in_(pallet_type))
     if pallet_location:
-        q = q.filter(models.PalletLog.pallet_location.in_(pallet_location))
+        stmt = stmt.where(log.pallet_location.in_(pallet_location))
 
-    rows = (
-        q.order_by(models.PalletLog.timestamp.desc())
-        .offset(offset)
-        .limit(limit)
-        .all()
-    )
+    if cursor:
+        stmt = stmt.where(_palletlog_after(cursor))
+    stmt = stmt.order_by(*_palletlog_order())
+
+    if stream:
+        return StreamingResponse(_stream_palletlogs(stmt), media_type="application/x-ndjson")
+
+    if not cursor:
+        stmt = stmt.offset(offset)
+
+    def work(db: Session):
+        return db.execute(stmt.limit(limit)).scalars().all()
+
+    rows = await database.run_db(work)
+
+    # หน้าถัดไป: ส่ง cursor ทาง header (body ยังเป็น list เหมือนเดิม)
+    if len(rows) == limit:
+        response.headers["X-Next-Cursor"] = _encode_palletlog_cursor(rows[-1])
     return rows
 
+
 @app.get("/latest_palletlog", response_model=List[LatestPalletLogRead])
 def get_latest_palletlog(
+    request: Request,
+    response: Response,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: auth.Principal = Depends(auth.get_read_user),
     t_plate: Optional[List[str]] = Query(None, description="Filter by truck plate(s)"),
+    if_none_match: Optional[str] = Header(None),
 ):
-    q = db.query(models.VLatestPalletLog)
-
-
+    # version: แถวยอดที่เกี่ยวข้อง (updated_at ขยับทุกครั้งที่มี palletlog ใหม่)
+    balance = models.PalletBalance
+    version_q = select(func.count(), func.max(balance.updated_at))
+    if t_plate:
+        version_q = version_q.where(balance.t_plate.in_(t_plate))
+    etag = _etag("latest_palletlog", tuple(db.execute(version_q).one()), request.url.query)
+    if _etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+    response.headers["ETag"] = etag
+
+    q = db.query(
+        balance.last_timestamp.label("timestamp"),
+        balance.t_plate,
+        balance.pallet_current,
+    ).filter(balance.last_timestamp.isnot(None))
 
     # optional filter
     if t_plate:
-        q = q.filter(models.VLatestPalletLog.t_plate.in_(t_plate))
+        q = q.filter(balance.t_plate.in_(t_plate))
 
     rows = q.all()
     return rows
 
 
-@app.post("/gpsdata", response_model=List[VehicleCurrentDataCreate])
-def upsert_vehicle_data(
-    data_list: List[VehicleCurrentDataCreate] = Body(...),
+@app.get("/palletlogs/balances")
+def get_pallet_balances(
     db: Session = Depends(get_db),
+    current_user: auth.Principal = Depends(auth.get_current_user),
+    period: str = Query("day", pattern="^(day|week)$"),
+    start: Optional[date] = Query(None, description="default: 30 วันก่อน end"),
+    end: Optional[date] = Query(None, description="default: วันนี้"),
+    t_plate: Optional[List[str]] = Query(None),
+    by_location: bool = Query(False, description="แยกตาม pallet_location"),
+):
+    """
+    📈 (admin) ยอดคงเหลือ + รับเข้า/จ่ายออก/สุทธิ ต่อวันหรือสัปดาห์ของแต่ละ t_plate
+    ทุก period ใน [start, end] นับจาก log แรกของ t_plate (ไม่มีการเคลื่อนไหว = ยอดเดิม, เข้า/ออก 0)
+    คำนวณใน SQL (window function) ช่วงที่จบแล้วใช้ cache
+    (หลาย worker: log ย้อนหลังจาก worker อื่นเห็นช้าได้ถึง PALLET_SERIES_CACHE_TTL_SECONDS)
+    """
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+
+    end = end or date.today()
+    start = start or end - timedelta(days=30)
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+
+    rows = pallets.balance_series(db, period, start, end, t_plate, by_location)
+    return _json_response({"period": period, "start": start, "end": end, "rows": rows})
+
+
+@app.get("/palletlogs/reconcile")
+def reconcile_palletdata(
+    db: Session = Depends(get_db),
+    current_user: auth.Principal = Depends(auth.get_current_user),
+    start: date = Query(..., description="date_plan เริ่ม"),
+    end: date = Query(..., description="date_plan สิ้นสุด"),
+    all_rows: bool = Query(False, alias="all", description="รวมแถวที่ตรงกันด้วย"),
+):
+    """
+    🧮 (admin) เทียบจำนวนใน Palletdata (ต่อ load) กับ palletlog
+    รวมต่อ (วัน, t_plate, driver_name) แล้ว FULL JOIN ใน query เดียว
+    """
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+
+    rows = db.execute(pallets.reconcile_query(start, end, mismatched_only=not all_rows)).mappings().all()
+    return _json_response({"start": start, "end": end, "rows": [dict(r) for r in rows]})
+
+
+@app.post("/gpsdata")
+async def upsert_vehicle_data(
+    data_list: List[VehicleCurrentDataCreate] = Body(...),
 ):
     """
     ✅ Always bulk UPSERT for Vehicle Current Data
@@ -912,45 +1903,28 @@ def upsert_vehicle_data(
     - If gps_vendor = 'dtc' → match gps_id
     - If gps_vendor = 'thaitracking' → match plate_master
     - Updates if exists, inserts if new
+    - ทำแบบ set-based (ไม่กี่ statement ต่อ batch) และคืนเป็นจำนวนแถว
+    - GPS_BUFFER_ENABLED=1 → เข้า write-behind buffer (202) แล้ว flush เป็นรอบ
     """
-    results = []
-    inserted, updated = 0, 0
-
-    for data in data_list:
-        # 1️⃣ Determine lookup field
-        if data.gps_vendor == "dtc":
-            lookup_field = models.VehicleCurrentData.gps_id
-            lookup_value = data.gps_id
-        elif data.gps_vendor == "thaitracking":
-            lookup_field = models.VehicleCurrentData.plate_master
-            lookup_value = data.plate_master
-        else:
-            print(f"⚠️ Skipping unknown vendor: {data.gps_vendor}")
-            continue
-
-        # 2️⃣ Find existing record
-        record = db.query(models.VehicleCurrentData).filter(lookup_field == lookup_value).first()
-
-        # 3️⃣ Update or Insert
-        if record:
-            for key, value in data.dict(exclude_unset=True).items():
-                setattr(record, key, value)
-            record.updated_at = datetime.utcnow()
-            updated += 1
-        else:
-            record = models.VehicleCurrentData(
-                **data.dict(),
-                updated_at=datetime.utcnow(),
+    if vehicles.GPS_BUFFER_ENABLED:
+        try:
+            result = vehicles.gps_buffer.offer(data_list)
+        except vehicles.BufferFull as e:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=f"GPS ingest buffer full ({e}), retry later",
+                headers={"Retry-After": str(int(vehicles.GPS_BUFFER_FLUSH_SECONDS) or 1)},
             )
-            db.add(record)
-            inserted += 1
-
-        results.append(record)
+        return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=result)
 
-    # 4️⃣ Commit once for performance
-    db.commit()
-    for r in results:
-        db.refresh(r)
+    def work(db: Session):
+        counts = vehicles.upsert_vehicle_rows(db, data_list)
+        db.commit()
+        return counts
 
-    print(f"✅ Vehicle upsert complete → Inserted: {inserted}, Updated: {updated}, Total: {len(results)}")
-    return results
\ No newline at end of file
+    counts = await database.run_db(work)
+    print(
+        f"✅ Vehicle upsert complete → Inserted: {counts['inserted']}, "
+        f"Updated: {counts['updated']}, Total: {counts['total']}"
+    )
+    return counts
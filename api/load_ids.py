@@ -0,0 +1,59 @@
+"""
+ออกเลข load_id รูปแบบ TDM-YYMMDD-NNN
+
+ใช้ตัวนับต่อวันใน fleetdata.load_id_counter (เพิ่มค่าแบบ atomic ด้วย UPDATE ... RETURNING)
+- จองได้ทีละหลายเลขใน round trip เดียว (bulk)
+- ไม่ชนกันเมื่อมีหลายคนสร้างงานพร้อมกัน
+- ไม่ออกเลขซ้ำหลังลบงาน (ตัวนับไม่ลดลง)
+"""
+from datetime import date
+
+from sqlalchemy import Integer, cast, func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from . import models
+
+LOAD_ID_PREFIX = "TDM"
+
+
+def format_load_id(date_plan: date, running: int) -> str:
+    # YYMMDD (เช่น 250806) + running padding 0 (เช่น 001)
+    return f"{LOAD_ID_PREFIX}-{date_plan.strftime('%y%m%d')}-{running:03d}"
+
+
+def _max_existing_running(db: Session, date_plan: date) -> int:
+    """เลข running สูงสุดของวันนั้นที่มีอยู่แล้ว (ข้อมูลก่อนมีตัวนับ)"""
+    prefix = f"{LOAD_ID_PREFIX}-{date_plan.strftime('%y%m%d')}-"
+    running = func.substring(models.Job.load_id, len(prefix) + 1)
+    return db.execute(
+        select(func.coalesce(func.max(cast(running, Integer)), 0))
+        .where(models.Job.load_id.like(f"{prefix}%"), running.regexp_match(r"^\d+$"))
+    ).scalar_one()
+
+
+def allocate_load_ids(db: Session, date_plan: date, count: int = 1) -> list:
+    """
+    จอง load_id `count` เลขของ date_plan (อยู่ใน transaction เดียวกับการ insert job
+    ถ้า rollback เลขที่จองไว้ก็คืนด้วย)
+    """
+    counter = models.LoadIdCounter.__table__
+
+    last = db.execute(
+        counter.update()
+        .where(counter.c.date_plan == date_plan)
+        .values(last_value=counter.c.last_value + count)
+        .returning(counter.c.last_value)
+    ).scalar()
+
+    if last is None:
+        # วันแรกที่ใช้ตัวนับ: เริ่มต่อจากเลขที่มีอยู่แล้ว
+        seed = _max_existing_running(db, date_plan)
+        stmt = pg_insert(counter).values(date_plan=date_plan, last_value=seed + count)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[counter.c.date_plan],
+            set_={"last_value": counter.c.last_value + count},
+        ).returning(counter.c.last_value)
+        last = db.execute(stmt).scalar_one()
+
+    return [format_load_id(date_plan, n) for n in range(last - count + 1, last + 1)]
@@ -1,5 +1,6 @@
-from sqlalchemy import Column, String, Integer, Date, DateTime , TIMESTAMP , Interval,Text
+from sqlalchemy import Column, String, Integer, BigInteger, Date, DateTime , TIMESTAMP , Interval,Text, Index, literal_column, text, or_
 from .database import Base
+from .status_engine import READY_STATUS, DELIVERED_STATUS
 from sqlalchemy.dialects.postgresql import TIMESTAMP as PG_TIMESTAMP
 from sqlalchemy.sql import func
 
@@ -22,7 +23,12 @@ from sqlalchemy.dialects.postgresql import UUID
 
 class Job(Base):
     __tablename__ = "jobdata"
-    __table_args__ = {"schema": "fleetdata"}
+    __table_args__ = (
+        # /jobs/changes: ไล่ change_xid ของคนขับแต่ละคน / ทั้ง table (admin)
+        Index("ix_jobdata_driver_name_change_xid", "driver_name", "change_xid"),
+        Index("ix_jobdata_change_xid_load_id", "change_xid", "load_id"),
+        {"schema": "fleetdata"},
+    )
 
     load_id = Column(String, primary_key=True, index=True)
     date_plan = Column(Date)
@@ -58,7 +64,55 @@ class Job(Base):
     # DB-generated columns (don’t set these on insert)
     group_key = Column(String)                 # keep if you still have it
     group_key_uuid = Column(UUID(as_uuid=True), index=True)
-       
+
+    # xid ของ transaction ที่เขียนแถวนี้ล่าสุด (trigger jobdata_change_xid ตั้งให้ทุก INSERT/UPDATE)
+    # ใช้เป็น cursor ของ /jobs/changes แทน updated_at ที่มาจากนาฬิกาของ app
+    change_xid = Column(BigInteger)
+
+
+# /jobs เรียง date_plan ใหม่ -> เก่า โดย NULL อยู่ท้าย
+# ค่าคงที่เขียนเป็น literal (ไม่ใช่ bind param) ให้ expression ตรงกับ index
+JOB_PLAN_KEY = func.coalesce(Job.date_plan, literal_column("DATE '0001-01-01'"))
+
+# สถานะที่ /jobs ดันไปท้ายรายการ (งานส่วนใหญ่ในประวัติเป็น POD)
+# แยก partial index ตามช่วงสถานะ ช่วง "งานที่ยังวิ่ง" จะไม่ต้องไล่ผ่านแถว POD ทั้ง table
+JOB_SORT_LAST_STATUSES = [READY_STATUS, DELIVERED_STATUS]
+JOB_LAST_STATUS = Job.status.in_([literal_column(f"'{s}'") for s in JOB_SORT_LAST_STATUSES])
+JOB_OPEN_STATUS = or_(Job.status.is_(None), ~JOB_LAST_STATUS)
+Index(
+    "ix_jobdata_open_plan_key_load_id", JOB_PLAN_KEY.desc(), Job.load_id,
+    postgresql_where=JOB_OPEN_STATUS,
+)
+Index(
+    "ix_jobdata_last_plan_key_load_id", JOB_PLAN_KEY.desc(), Job.load_id,
+    postgresql_where=JOB_LAST_STATUS,
+)
+
+
+class LoadIdCounter(Base):
+    """เลข running ล่าสุดของ load_id ต่อ date_plan (ดู api/load_ids.py)"""
+    __tablename__ = "load_id_counter"
+    __table_args__ = {"schema": "fleetdata"}
+
+    date_plan = Column(Date, primary_key=True)
+    last_value = Column(Integer, nullable=False)
+
+
+class JobTombstone(Base):
+    """job ที่ถูกลบ (หรือย้ายไปคนขับอื่น) ให้ /jobs/changes แจ้งแอปคนขับ"""
+    __tablename__ = "jobdata_tombstone"
+    __table_args__ = (
+        Index("ix_jobdata_tombstone_driver_name_change_xid", "driver_name", "change_xid"),
+        Index("ix_jobdata_tombstone_change_xid_load_id", "change_xid", "load_id"),
+        {"schema": "fleetdata"},
+    )
+
+    load_id = Column(String, primary_key=True)
+    deleted_at = Column(DateTime, primary_key=True)
+    driver_name = Column(String)
+    deleted_by = Column(String(100))
+    change_xid = Column(BigInteger, server_default=text("pg_current_xact_id()::text::bigint"))
+
     
 class Ticket(Base):
     __tablename__ = "ticketdata"
@@ -116,10 +170,27 @@ class PalletLog(Base):
     pallet_qty = Column(Integer, nullable=False)  # int2
     pallet_location = Column(String, nullable=False)
     pallet_remark = Column(String)                # nullable
-    
+
+
+# /palletlogs: กรองตามรถ / คนขับ แล้วเรียงเวลาล่าสุดก่อน
+Index("ix_palletlog_t_plate_timestamp", PalletLog.t_plate, PalletLog.timestamp.desc())
+Index("ix_palletlog_driver_name_timestamp", PalletLog.driver_name, PalletLog.timestamp.desc())
+
+
+class PalletBalance(Base):
+    """ยอดพาเลทล่าสุดต่อ t_plate อัปเดตพร้อมกับการเพิ่ม palletlog (ดู api/pallets.py)"""
+    __tablename__ = "pallet_balance"
+    __table_args__ = {"schema": "fleetdata"}
+
+    t_plate = Column(String, primary_key=True)
+    pallet_current = Column(Integer, nullable=False)
+    last_timestamp = Column(DateTime)            # timestamp ของ log ล่าสุด
+    updated_at = Column(DateTime, nullable=False)
+
+
 class VLatestPalletLog(Base):
     __tablename__ = "v_latest_palletlog"   # your view
-    __table_args__ = {"schema": "fleetdata"}
+    __table_args__ = {"schema": "fleetdata", "info": {"is_view": True}}  # bootstrap ไม่สร้างเป็น table
 
     timestamp = Column(DateTime)
     t_plate = Column(String, primary_key=True)   # each t_plate has 1 latest row
@@ -127,7 +198,7 @@ class VLatestPalletLog(Base):
     
 class DWJobData(Base):
     __tablename__ = "dw_jobdata"     # ใช้ชื่อ view
-    __table_args__ = {"schema": "fleetdata"}  # ถ้าอยู่ใน schema
+    __table_args__ = {"schema": "fleetdata", "info": {"is_view": True}}  # ถ้าอยู่ใน schema
 
     load_id = Column(String, primary_key=True)   # ต้องมี PK (เลือก column ที่ unique)
 
@@ -139,6 +210,16 @@ class DWJobData(Base):
     
 
 
+class SchemaVersion(Base):
+    """migration ที่ apply แล้ว (ดู api/bootstrap.py)"""
+    __tablename__ = "schema_version"
+    __table_args__ = {"schema": "fleetdata"}
+
+    version = Column(Integer, primary_key=True)
+    description = Column(String)
+    applied_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
 class VehicleCurrentData(Base):
     __tablename__ = "vehicle_curent_data"
     __table_args__ = {"schema": "fleetdata"}
@@ -0,0 +1,414 @@
+"""
+ยอดพาเลทต่อ t_plate (fleetdata.pallet_balance)
+
+- apply_palletlog(): เพิ่ม palletlog + ปรับยอดใน transaction เดียว
+  ล็อกแถวยอดของ t_plate (SELECT ... FOR UPDATE) กันสอง request อ่านยอดเดิมพร้อมกัน
+- rebuild_balances(): สร้างยอดใหม่จาก palletlog ล่าสุดของแต่ละ t_plate
+- balance_series(): ยอด/การเคลื่อนไหวรายวัน-รายสัปดาห์ (window function)
+  ทุก period ในช่วง (วันที่ไม่มีการเคลื่อนไหว = ยอดเดิม, เข้า/ออก 0)
+  ช่วงที่จบแล้วเก็บ cache ไว้ใน process อายุ PALLET_SERIES_CACHE_TTL_SECONDS
+  (palletlog ย้อนหลังล้าง cache ของ worker ที่รับ request ทันที worker อื่นรอหมดอายุ)
+- reconcile(): เทียบ Palletdata ของแต่ละ load กับ palletlog
+
+    python -m api.pallets rebuild
+"""
+import os
+import sys
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, time, timedelta
+from time import monotonic
+
+from sqlalchemy import DateTime, Integer, and_, case, cast, func, literal_column, or_, select, text, true, union_all
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import naive_timestamp
+
+# pallet_type → ทิศทางของยอด
+PALLET_IN_TYPES = ["รับคืน", "ยืมลค."]
+PALLET_OUT_TYPES = ["นำฝาก", "คืนลค."]
+
+# คอลัมน์ Palletdata ↔ pallet_type ของ palletlog
+PALLETDATA_TYPES = {
+    "return_pallet": "รับคืน",
+    "borrow_customer_pallet": "ยืมลค.",
+    "drop_pallet": "นำฝาก",
+    "return_customer_pallet": "คืนลค.",
+}
+
+SERIES_PERIODS = ("day", "week")
+SERIES_CACHE_SIZE = int(os.getenv("PALLET_SERIES_CACHE_SIZE", "256"))
+# cache อยู่ใน process: หลาย worker เห็น palletlog ย้อนหลังของกันและกันช้าได้ไม่เกินนี้
+SERIES_CACHE_TTL_SECONDS = float(os.getenv("PALLET_SERIES_CACHE_TTL_SECONDS", "300"))
+SERIES_STEPS = {"day": timedelta(days=1), "week": timedelta(weeks=1)}
+
+
+def pallet_delta(pallet_type: str, qty: int) -> int:
+    if pallet_type in PALLET_IN_TYPES:
+        return qty
+    if pallet_type in PALLET_OUT_TYPES:
+        return -qty
+    return 0
+
+
+def _latest_log(t_plate):
+    return (
+        select(models.PalletLog.pallet_current, models.PalletLog.timestamp)
+        .where(models.PalletLog.t_plate == t_plate)
+        .order_by(models.PalletLog.timestamp.desc())
+        .limit(1)
+    )
+
+
+def lock_balance(db: Session, t_plate: str) -> models.PalletBalance:
+    """
+    คืนแถวยอดของ t_plate แบบล็อกไว้จนจบ transaction
+    ถ้ายังไม่มี seed จาก palletlog ล่าสุด (ON CONFLICT DO NOTHING กันสร้างซ้ำ)
+    """
+    locked = (
+        select(models.PalletBalance)
+        .where(models.PalletBalance.t_plate == t_plate)
+        .with_for_update()
+    )
+    balance = db.execute(locked).scalar_one_or_none()
+    if balance is not None:
+        return balance
+
+    table = models.PalletBalance.__table__
+    latest = db.execute(_latest_log(t_plate)).first()
+    db.execute(
+        pg_insert(table)
+        .values(
+            t_plate=t_plate,
+            pallet_current=(latest.pallet_current or 0) if latest else 0,
+            last_timestamp=latest.timestamp if latest else None,
+            updated_at=datetime.now(),
+        )
+        .on_conflict_do_nothing(index_elements=[table.c.t_plate])
+    )
+    return db.execute(locked).scalar_one()
+
+
+def apply_palletlog(db: Session, data) -> tuple:
+    """
+    เพิ่ม palletlog และปรับยอดของ t_plate (ไม่ commit)
+    คืน (pallet_current ใหม่, timestamp ของ log ก่อนหน้า)
+    ผู้เรียก commit แล้วต้องเรียก invalidate_series(data.timestamp)
+    """
+    timestamp = naive_timestamp(data.timestamp)
+    balance = lock_balance(db, data.t_plate)
+    last_timestamp = balance.last_timestamp
+    new_current = balance.pallet_current + pallet_delta(data.pallet_type, data.pallet_qty)
+
+    db.add(models.PalletLog(
+        **data.dict(exclude={"pallet_current", "timestamp"}),
+        timestamp=timestamp,
+        pallet_current=new_current
+    ))
+
+    balance.pallet_current = new_current
+    if last_timestamp is None or timestamp > last_timestamp:
+        balance.last_timestamp = timestamp
+    balance.updated_at = datetime.now()
+    db.flush()
+    return new_current, last_timestamp
+
+
+def invalidate_series(timestamp: datetime):
+    """
+    เรียกหลัง commit palletlog: log ย้อนหลังเข้าไปในช่วงที่ cache ไว้ → ล้าง cache
+    (ล้างก่อน commit แล้ว request อื่นอาจ cache ยอดก่อน commit กลับเข้าไปใหม่)
+    """
+    if naive_timestamp(timestamp) < _period_start("day", date.today()):
+        series_cache.clear()
+
+
+def rebuild_balances(db: Session) -> int:
+    """
+    ตั้งยอดทุก t_plate ใหม่ตาม palletlog ล่าสุด (ไม่ commit)
+    ล็อกตารางยอดไว้ระหว่างทำ ไม่ให้ palletlog ใหม่แทรกกลางทาง
+    """
+    table = models.PalletBalance.__table__
+    log = models.PalletLog
+    db.execute(text(f"LOCK TABLE {table.fullname} IN EXCLUSIVE MODE"))
+
+    ranked = select(
+        log.t_plate,
+        log.pallet_current,
+        log.timestamp,
+        func.row_number().over(partition_by=log.t_plate, order_by=log.timestamp.desc()).label("rn"),
+    ).subquery()
+    latest = select(
+        ranked.c.t_plate,
+        func.coalesce(ranked.c.pallet_current, 0),
+        ranked.c.timestamp,
+        func.now(),
+    ).where(ranked.c.rn == 1)
+    stmt = pg_insert(table).from_select(
+        ["t_plate", "pallet_current", "last_timestamp", "updated_at"], latest
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.t_plate],
+        set_={c: stmt.excluded[c] for c in ("pallet_current", "last_timestamp", "updated_at")},
+        # ไม่แตะแถวที่ตรงอยู่แล้ว (updated_at ไม่ขยับ → ETag เดิม)
+        where=(
+            table.c.pallet_current.is_distinct_from(stmt.excluded.pallet_current)
+            | table.c.last_timestamp.is_distinct_from(stmt.excluded.last_timestamp)
+        ),
+    )
+    changed = db.execute(stmt).rowcount
+
+    # t_plate ที่ไม่มี palletlog เหลือแล้ว
+    changed += db.execute(
+        table.delete().where(~table.c.t_plate.in_(select(log.t_plate)))
+    ).rowcount
+    return changed
+
+
+# -------------------------
+# TIME-SERIES
+# -------------------------
+class SeriesCache:
+    """
+    TTL + LRU ของผลลัพธ์ช่วงที่จบแล้ว (ล้างเมื่อมี palletlog ย้อนหลัง)
+    generation: ผลที่ query ก่อน clear() แต่ put หลัง clear() จะไม่ถูกเก็บ
+    """
+
+    def __init__(self, ttl: float = SERIES_CACHE_TTL_SECONDS, maxsize: int = SERIES_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.generation = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value, generation: int):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._data[key] = (value, monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+
+series_cache = SeriesCache()
+
+
+def _period_start(period: str, day: date) -> datetime:
+    if period == "week":
+        day = day - timedelta(days=day.weekday())   # จันทร์ (ตรงกับ date_trunc('week'))
+    return datetime.combine(day, time.min)
+
+
+def _series_query(period: str, start: datetime, end: datetime, t_plates, by_location: bool):
+    log = models.PalletLog
+    bucket = func.date_trunc(period, log.timestamp).label("period")
+    qty_in = func.sum(case((log.pallet_type.in_(PALLET_IN_TYPES), log.pallet_qty), else_=0))
+    qty_out = func.sum(case((log.pallet_type.in_(PALLET_OUT_TYPES), log.pallet_qty), else_=0))
+    keys = [log.t_plate] + ([log.pallet_location] if by_location else [])
+
+    # ยอดสะสมต้องนับตั้งแต่ log แรก จึงไม่ตัด start ก่อนทำ window
+    moves = select(
+        bucket,
+        *keys,
+        qty_in.label("qty_in"),
+        qty_out.label("qty_out"),
+        (qty_in - qty_out).label("net"),
+    ).where(log.timestamp < end)
+    if t_plates:
+        moves = moves.where(log.t_plate.in_(t_plates))
+    moves = moves.group_by(bucket, *keys).subquery()
+    names = [c.name for c in keys]
+
+    # เส้นเวลาของแต่ละกลุ่ม: period ก่อน start ที่มีการเคลื่อนไหว (ไว้สะสมยอด)
+    # + ทุก period ใน [start, end) (generate_series) วันที่ไม่มี log จะได้แถวด้วย
+    groups = select(*[moves.c[n] for n in names]).distinct().subquery()
+    step = literal_column(f"interval '1 {period}'")
+    periods = select(
+        func.generate_series(
+            cast(start, DateTime), cast(end - SERIES_STEPS[period], DateTime), step
+        ).label("period")
+    ).subquery()
+    timeline = union_all(
+        select(*[moves.c[n] for n in names], moves.c.period).where(moves.c.period < start),
+        select(*[groups.c[n] for n in names], periods.c.period).select_from(groups).join(periods, true()),
+    ).subquery()
+
+    matched = and_(
+        moves.c.period == timeline.c.period,
+        *[moves.c[n] == timeline.c[n] for n in names],
+    )
+    partition = [timeline.c[n] for n in names]
+    net = func.coalesce(moves.c.net, 0)
+    running = (
+        select(
+            timeline.c.period,
+            *partition,
+            func.coalesce(moves.c.qty_in, 0).label("qty_in"),
+            func.coalesce(moves.c.qty_out, 0).label("qty_out"),
+            net.label("net"),
+            cast(func.sum(net).over(partition_by=partition, order_by=timeline.c.period), Integer).label("balance"),
+            # period ก่อน log แรกของกลุ่มยังไม่มียอด → ไม่ส่ง
+            func.count(moves.c.period).over(partition_by=partition, order_by=timeline.c.period).label("moved"),
+        )
+        .select_from(timeline)
+        .outerjoin(moves, matched)
+        .subquery()
+    )
+    return (
+        select(*[c for c in running.c if c.name != "moved"])
+        .where(running.c.period >= start, running.c.moved > 0)
+        .order_by(*[running.c[n] for n in names], running.c.period)
+    )
+
+
+def _series_rows(db: Session, period, start, end, t_plates, by_location) -> list:
+    result = db.execute(_series_query(period, start, end, t_plates, by_location))
+    return [dict(row) for row in result.mappings()]
+
+
+def balance_series(
+    db: Session,
+    period: str,
+    start: date,
+    end: date,
+    t_plates: list = None,
+    by_location: bool = False,
+) -> list:
+    """
+    ยอดคงเหลือและการเคลื่อนไหวสุทธิต่อ period ของ t_plate (และ pallet_location)
+    ครอบคลุม period ที่เริ่มในช่วง [start, end]
+    """
+    start_at = _period_start(period, start)
+    end_at = _period_start(period, end) + (timedelta(weeks=1) if period == "week" else timedelta(days=1))
+    open_at = _period_start(period, date.today())
+    plates = tuple(sorted(t_plates)) if t_plates else None
+
+    rows = []
+    # period ที่จบแล้ว → cache
+    if start_at < open_at:
+        closed_end = min(end_at, open_at)
+        key = (period, start_at, closed_end, plates, by_location)
+        closed = series_cache.get(key)
+        if closed is None:
+            generation = series_cache.generation
+            closed = _series_rows(db, period, start_at, closed_end, plates, by_location)
+            series_cache.put(key, closed, generation)
+        rows.extend(closed)
+    # period ปัจจุบัน (ยังเปลี่ยนได้) → query สด
+    if end_at > open_at:
+        rows.extend(_series_rows(db, period, max(start_at, open_at), end_at, plates, by_location))
+
+    group = (lambda r: (r["t_plate"], r["pallet_location"])) if by_location else (lambda r: r["t_plate"])
+    rows.sort(key=lambda r: (group(r), r["period"]))
+    return rows
+
+
+# -------------------------
+# RECONCILIATION
+# -------------------------
+def reconcile_query(start: date, end: date, mismatched_only: bool = True):
+    """
+    Palletdata (รวมต่อ date_plan, t_plate, driver_name ผ่าน jobdata)
+    เทียบกับ palletlog (รวมต่อวันของ timestamp, t_plate, driver_name) ใน query เดียว
+    """
+    job, pd, log = models.Job, models.Palletdata, models.PalletLog
+
+    planned = (
+        select(
+            job.date_plan.label("day"),
+            job.t_plate,
+            job.driver_name,
+            *[func.coalesce(func.sum(getattr(pd, col)), 0).label(col) for col in PALLETDATA_TYPES],
+        )
+        .join(pd, pd.load_id == job.load_id)
+        .where(job.date_plan >= start, job.date_plan <= end)
+        .group_by(job.date_plan, job.t_plate, job.driver_name)
+        .cte("planned")
+    )
+
+    log_day = func.date(log.timestamp)
+    logged = (
+        select(
+            log_day.label("day"),
+            log.t_plate,
+            log.driver_name,
+            *[
+                func.coalesce(func.sum(case((log.pallet_type == t, log.pallet_qty))), 0).label(col)
+                for col, t in PALLETDATA_TYPES.items()
+            ],
+        )
+        .where(
+            log.timestamp >= datetime.combine(start, time.min),
+            log.timestamp < datetime.combine(end + timedelta(days=1), time.min),
+        )
+        .group_by(log_day, log.t_plate, log.driver_name)
+        .cte("logged")
+    )
+
+    on = (
+        (planned.c.day == logged.c.day)
+        & (planned.c.t_plate == logged.c.t_plate)
+        & (planned.c.driver_name == logged.c.driver_name)
+    )
+    diffs = []
+    columns = []
+    for col in PALLETDATA_TYPES:
+        p = func.coalesce(planned.c[col], 0)
+        l = func.coalesce(logged.c[col], 0)
+        columns += [p.label(f"{col}_palletdata"), l.label(f"{col}_palletlog")]
+        diffs.append(p != l)
+
+    keys = [
+        func.coalesce(planned.c[c], logged.c[c]).label(c)
+        for c in ("day", "t_plate", "driver_name")
+    ]
+    stmt = (
+        select(
+            *keys,
+            *columns,
+            planned.c.day.isnot(None).label("in_palletdata"),
+            logged.c.day.isnot(None).label("in_palletlog"),
+        )
+        .select_from(planned.join(logged, on, full=True))
+        .order_by(*keys)
+    )
+    if mismatched_only:
+        stmt = stmt.where(or_(*diffs))
+    return stmt
+
+
+if __name__ == "__main__":
+    from .database import SessionLocal
+
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit("usage: python -m api.pallets rebuild")
+
+    db = SessionLocal()
+    try:
+        changed = rebuild_balances(db)
+        db.commit()
+    finally:
+        db.close()
+    print(f"✅ Pallet balances rebuilt → {changed} row(s) changed")
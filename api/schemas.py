@@ -70,7 +70,7 @@ class JobSchema(BaseModel):
 
 
 from pydantic import BaseModel, model_validator
-from typing import Optional
+from typing import List, Optional
 from datetime import date, datetime
 
 class JobUpdateSchema(BaseModel):
@@ -191,6 +191,21 @@ class JobUpdateSchemaCreate(BaseModel):
                 raise ValueError(f"{field} is required and cannot be empty")
         return self
     
+class JobBulkDeleteRequest(BaseModel):
+    load_ids: Optional[List[str]] = None
+    date_plan_start: Optional[date] = None
+    date_plan_end: Optional[date] = None
+
+    @model_validator(mode="after")
+    def need_selector(self):
+        # ช่วงวันที่ต้องส่งครบทั้งคู่ ไม่งั้นเงื่อนไขวันที่จะหายไปเงียบๆ แล้วลบกว้างกว่าที่ตั้งใจ
+        if (self.date_plan_start is None) != (self.date_plan_end is None):
+            raise ValueError("date_plan_start and date_plan_end must be sent together")
+        if not self.load_ids and not (self.date_plan_start and self.date_plan_end):
+            raise ValueError("load_ids or date_plan_start + date_plan_end is required")
+        return self
+
+
 class RegisterRequest(BaseModel):
     username: str
     password: str = Field(..., alias="hashed_password")
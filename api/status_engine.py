@@ -0,0 +1,90 @@
+"""
+สถานะ job คำนวณจาก milestone ของ ticket
+
+แต่ละบริษัท (locat_recive) มีตารางลำดับ milestone จากล่าสุด → ย้อนหลัง
+milestone แรกที่มีค่า = สถานะของ job, ไม่มีเลย = พร้อมรับงาน
+ตารางเดียวกันถูก compile เป็น
+- evaluator ใน Python (ใช้ตอนอัปเดต ticket)
+- SQL CASE (ใช้ตอน recompute ทีละช่วงวันแบบ bulk)
+"""
+from operator import itemgetter
+
+from sqlalchemy import case, func
+
+READY_STATUS = "พร้อมรับงาน"
+DELIVERED_STATUS = "จัดส่งแล้ว (POD)"
+
+DEFAULT_MILESTONES = [
+    ("complete_datetime", DELIVERED_STATUS),
+    ("end_unload_datetime", "ลงสินค้าเสร็จ"),
+    ("start_unload_datetime", "เริ่มลงสินค้า"),
+    ("desination_datetime", "ถึงปลายทาง"),   # ชื่อฟิลด์สะกดตามโมเดลเดิม
+    ("intransit_datetime", "เริ่มขนส่ง"),
+    ("end_recive_datetime", "ขึ้นสินค้าเสร็จ"),
+    ("start_recive_datetime", "เริ่มขึ้นสินค้า"),
+    ("origin_datetime", "ถึงต้นทาง"),
+    ("start_datetime", "รับงาน"),
+]
+
+NEO_MILESTONES = [
+    ("complete_datetime", DELIVERED_STATUS),
+    ("docs_returned_datetime", "ได้รับเอกสารคืน"),
+    ("end_unload_datetime", "ลงสินค้าเสร็จ"),
+    ("start_unload_datetime", "เริ่มลงสินค้า"),
+    ("docs_submitted_datetime", "ยื่นเอกสาร"),
+    ("desination_datetime", "ถึงปลายทาง"),
+    ("intransit_datetime", "เริ่มขนส่ง"),
+    ("end_recive_datetime", "ขึ้นสินค้าเสร็จ"),
+    ("start_recive_datetime", "เริ่มขึ้นสินค้า"),
+    ("origin_datetime", "ถึงต้นทาง"),
+    ("start_datetime", "รับงาน"),
+]
+
+# 🗺️ Mapping locat_recive → ตาราง milestone
+CUSTOMER_MILESTONES = {
+    "บริษัท นีโอ แฟคทอรี่ จำกัด": NEO_MILESTONES,
+    # สามารถเพิ่ม mapping บริษัทอื่นได้ที่นี่
+}
+
+
+def compile_milestones(milestones: list):
+    """ตาราง milestone → function(ticket: Mapping) -> status"""
+    fields = [f for f, _ in milestones]
+    statuses = tuple(s for _, s in milestones)
+    getter = itemgetter(*fields) if len(fields) > 1 else (lambda t: (t[fields[0]],))
+
+    def evaluate(ticket) -> str:
+        for value, status in zip(getter(ticket), statuses):
+            if value:
+                return status
+        return READY_STATUS
+
+    return evaluate
+
+
+_DEFAULT_EVALUATOR = compile_milestones(DEFAULT_MILESTONES)
+_EVALUATORS = {name: compile_milestones(m) for name, m in CUSTOMER_MILESTONES.items()}
+
+
+def compute_status(ticket, locat_recive: str = None) -> str:
+    """ticket เป็น dict (หรือ Mapping) ของคอลัมน์ ticketdata"""
+    return _EVALUATORS.get(locat_recive, _DEFAULT_EVALUATOR)(ticket)
+
+
+def _milestone_case(ticket_table, milestones: list):
+    # ค่าว่าง "" นับเป็นไม่มีค่า เหมือน truthiness ใน Python
+    return case(
+        *[(func.coalesce(ticket_table.c[f], "") != "", status) for f, status in milestones],
+        else_=READY_STATUS,
+    )
+
+
+def status_case(ticket_table, locat_recive_col):
+    """SQL CASE ที่ให้ผลเดียวกับ compute_status()"""
+    return case(
+        *[
+            (locat_recive_col == name, _milestone_case(ticket_table, m))
+            for name, m in CUSTOMER_MILESTONES.items()
+        ],
+        else_=_milestone_case(ticket_table, DEFAULT_MILESTONES),
+    )
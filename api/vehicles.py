@@ -0,0 +1,279 @@
+"""
+Bulk UPSERT ของ vehicle_curent_data สำหรับ /gpsdata
+และ write-behind buffer ที่รวมตำแหน่งซ้ำของรถคันเดียวกันก่อนเขียนลง DB
+"""
+import logging
+import os
+import threading
+from datetime import datetime
+
+from sqlalchemy import cast, literal_column, or_, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from . import models
+from .bulk import chunked, group_by_columns, update_from_values
+from .database import SessionLocal, naive_timestamp
+
+logger = logging.getLogger(__name__)
+
+# gps_vendor → คอลัมน์ที่ใช้จับคู่กับแถวเดิม
+VENDOR_KEYS = {
+    "dtc": "gps_id",
+    "thaitracking": "plate_master",
+}
+
+# write-behind buffer (เปิดเฉพาะ process ที่รันยาว เช่น uvicorn)
+GPS_BUFFER_ENABLED = os.getenv("GPS_BUFFER_ENABLED", "0") == "1"
+GPS_BUFFER_MAX_PENDING = int(os.getenv("GPS_BUFFER_MAX_PENDING", "20000"))
+GPS_BUFFER_FLUSH_SIZE = int(os.getenv("GPS_BUFFER_FLUSH_SIZE", "5000"))
+GPS_BUFFER_FLUSH_SECONDS = float(os.getenv("GPS_BUFFER_FLUSH_SECONDS", "5"))
+
+
+def record_key(data):
+    """(คอลัมน์, ค่า) ที่ใช้จับคู่ record นี้ หรือ None ถ้า vendor ไม่รู้จัก"""
+    key = VENDOR_KEYS.get(data.gps_vendor)
+    if key is None:
+        return None
+    # dtc ที่ไม่มี gps_id จับคู่ด้วย plate_master แทน
+    if key == "gps_id" and not data.gps_id:
+        key = "plate_master"
+    return key, getattr(data, key)
+
+
+def is_newer(new, old) -> bool:
+    """new ไม่เก่ากว่า old (ไม่รู้เวลา GPS ฝั่งใดฝั่งหนึ่ง = ถือว่าใหม่กว่า)"""
+    if new.gps_updated_at is None or old.gps_updated_at is None:
+        return True
+    try:
+        return new.gps_updated_at >= old.gps_updated_at
+    except TypeError:
+        # naive กับ aware เทียบกันไม่ได้
+        return True
+
+
+def normalize_record(data):
+    """gps_updated_at ที่มี tz → เวลา DB_TIMEZONE แบบ naive ตามคอลัมน์ (TIMESTAMP ไม่มี tz)"""
+    if data.gps_updated_at is None or data.gps_updated_at.tzinfo is None:
+        return data
+    return data.model_copy(update={"gps_updated_at": naive_timestamp(data.gps_updated_at)})
+
+
+def _not_stale(table, incoming):
+    # ตำแหน่งที่เก่ากว่าใน DB ไม่ทับของใหม่
+    return or_(
+        incoming.is_(None),
+        table.c.gps_updated_at.is_(None),
+        incoming >= table.c.gps_updated_at,
+    )
+
+
+def upsert_vehicle_rows(db: Session, records: list) -> dict:
+    """
+    UPSERT ตำแหน่งรถหลายคันแบบ set-based (ไม่ commit)
+    - dtc          → UPDATE ... FROM (VALUES) จับคู่ gps_id, ที่ไม่เจอ → INSERT
+    - thaitracking → INSERT ... ON CONFLICT (plate_master) DO UPDATE
+    อัปเดตเฉพาะฟิลด์ที่ vendor ส่งมา (exclude_unset) เหมือนเดิม
+    ถ้า key เดียวกันมาซ้ำใน batch ใช้ record ที่ gps_updated_at ใหม่สุด
+    แถวที่ gps_updated_at เก่ากว่าใน DB จะไม่ถูกเขียนทับ (นับเป็น stale)
+    """
+    table = models.VehicleCurrentData.__table__
+    now = datetime.utcnow()
+    inserted = updated = skipped = stale = 0
+
+    # { (key column, key value): record }
+    latest = {}
+    for data in map(normalize_record, records):
+        key = record_key(data)
+        if key is None:
+            print(f"⚠️ Skipping unknown vendor: {data.gps_vendor}")
+            skipped += 1
+            continue
+        current = latest.get(key)
+        if current is None or is_newer(data, current):
+            latest[key] = data
+        else:
+            stale += 1
+
+    # 1️⃣ dtc: UPDATE by gps_id
+    gps_ids = [value for (key, value) in latest if key == "gps_id"]
+    existing = set()
+    for chunk in chunked(gps_ids):
+        existing.update(db.execute(select(table.c.gps_id).where(table.c.gps_id.in_(chunk))).scalars())
+
+    matched = [latest[("gps_id", g)].dict(exclude_unset=True) for g in gps_ids if g in existing]
+    for group in group_by_columns(matched).values():
+        columns = list(group[0])
+        guard = None
+        if "gps_updated_at" in columns:
+            guard = lambda v: _not_stale(table, cast(v.c.gps_updated_at, table.c.gps_updated_at.type))
+        for chunk in chunked(group):
+            stmt = update_from_values(
+                table, "gps_id", chunk, columns, extra={"updated_at": now}, where=guard
+            ).returning(table.c.gps_id)
+            n = len(db.execute(stmt).all())
+            updated += n
+            stale += len(chunk) - n
+
+    # 2️⃣ ที่เหลือ: INSERT ... ON CONFLICT (plate_master) DO UPDATE
+    pending = {}
+    for (key, value), data in latest.items():
+        if key == "gps_id" and value in existing:
+            continue
+        current = pending.get(data.plate_master)
+        if current is None or is_newer(data, current):
+            pending[data.plate_master] = data
+
+    groups = {}
+    for data in pending.values():
+        groups.setdefault(tuple(sorted(data.dict(exclude_unset=True))), []).append(data.dict())
+
+    for sent_columns, group in groups.items():
+        for chunk in chunked(group):
+            stmt = pg_insert(table).values([{**full, "updated_at": now} for full in chunk])
+            set_ = {c: stmt.excluded[c] for c in sent_columns if c != "plate_master"}
+            set_["updated_at"] = stmt.excluded.updated_at
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c.plate_master],
+                set_=set_,
+                where=_not_stale(table, stmt.excluded.gps_updated_at) if "gps_updated_at" in sent_columns else None,
+            ).returning(literal_column("xmax = 0").label("inserted"))
+            results = db.execute(stmt).all()
+            for (was_insert,) in results:
+                if was_insert:
+                    inserted += 1
+                else:
+                    updated += 1
+            stale += len(chunk) - len(results)
+
+    return {
+        "inserted": inserted,
+        "updated": updated,
+        "skipped": skipped,
+        "stale": stale,
+        "total": inserted + updated,
+    }
+
+
+# -------------------------
+# WRITE-BEHIND BUFFER
+# -------------------------
+class BufferFull(Exception):
+    """buffer เต็ม ให้ vendor ส่งใหม่ภายหลัง (backpressure)"""
+
+
+class GpsIngestBuffer:
+    """
+    เก็บตำแหน่งล่าสุดต่อ plate_master / gps_id ไว้ในหน่วยความจำ
+    แล้ว flush ลง DB เมื่อครบ flush_size หรือทุก flush_seconds
+    - record ที่ gps_updated_at เก่ากว่าที่ค้างอยู่จะถูกทิ้ง
+    - record ของคันเดิมที่ส่งมาเฉพาะบางฟิลด์จะถูก merge ทับของเดิม
+    - ค้างเกิน max_pending → BufferFull
+    - stop() flush ที่ค้างทั้งหมดก่อนปิด
+    """
+
+    def __init__(
+        self,
+        max_pending: int = GPS_BUFFER_MAX_PENDING,
+        flush_size: int = GPS_BUFFER_FLUSH_SIZE,
+        flush_seconds: float = GPS_BUFFER_FLUSH_SECONDS,
+    ):
+        self.max_pending = max_pending
+        self.flush_size = flush_size
+        self.flush_seconds = flush_seconds
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"accepted": 0, "coalesced": 0, "stale": 0, "rejected": 0, "flushed": 0}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _merge(self, data) -> bool:
+        data = normalize_record(data)
+        key = record_key(data)
+        current = self._pending.get(key)
+        if current is None:
+            self._pending[key] = data
+            return True
+        if not is_newer(data, current):
+            self.stats["stale"] += 1
+            return False
+        self._pending[key] = current.model_copy(update=data.dict(exclude_unset=True))
+        self.stats["coalesced"] += 1
+        return True
+
+    def offer(self, records: list) -> dict:
+        known = [r for r in records if record_key(r) is not None]
+        with self._lock:
+            new_keys = {record_key(r) for r in known} - self._pending.keys()
+            if len(self._pending) + len(new_keys) > self.max_pending:
+                self.stats["rejected"] += len(records)
+                raise BufferFull(f"{len(self._pending)} positions pending")
+            for data in known:
+                self._merge(data)
+            self.stats["accepted"] += len(known)
+            pending = len(self._pending)
+
+        if pending >= self.flush_size:
+            self._wake.set()
+        return {
+            "accepted": len(known),
+            "skipped": len(records) - len(known),
+            "pending": pending,
+        }
+
+    def flush(self) -> dict:
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._pending.values())
+                self._pending = {}
+            if not batch:
+                return None
+
+            db = SessionLocal()
+            try:
+                counts = upsert_vehicle_rows(db, batch)
+                db.commit()
+            except Exception:
+                db.rollback()
+                # ใส่กลับเข้า buffer (ไม่ทับตำแหน่งที่ใหม่กว่าซึ่งเข้ามาระหว่าง flush)
+                with self._lock:
+                    for data in batch:
+                        self._merge(data)
+                raise
+            finally:
+                db.close()
+
+            self.stats["flushed"] += counts["total"]
+            return counts
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("GPS buffer flush failed, will retry")
+
+    def start(self):
+        if self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="gps-buffer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=30)
+            self._thread = None
+        self.flush()
+
+
+gps_buffer = GpsIngestBuffer()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# ให้ import api.* ได้เมื่อรัน pytest จาก root ของ repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,24 @@
+"""
+Cold-start budget: import api.index ต้องไม่เกิน IMPORT_BUDGET_MS (ดู api/importprofile.py)
+ไม่ต่อ DB (ใช้ DATABASE_URL placeholder ถ้าไม่ได้ตั้งไว้)
+"""
+from api import importprofile
+
+
+def test_import_within_budget(capsys):
+    code = importprofile.main(["--runs", "3", "--top", "10"])
+    out = capsys.readouterr().out
+    assert code == 0, out
+
+
+def test_budget_exceeded_fails(capsys):
+    assert importprofile.main(["--runs", "1", "--top", "1", "--budget-ms", "1"]) == 1
+    assert "exceeds budget" in capsys.readouterr().out
+
+
+def test_parse_importtime_rows():
+    rows = importprofile.run_importtime("json")
+    names = [name for name, _self_us, _cumulative in rows]
+    assert "json" in names
+    assert importprofile.total_us(rows, "json") > 0
+    assert "json" in importprofile.by_package(rows)
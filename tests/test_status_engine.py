@@ -0,0 +1,74 @@
+"""
+status_engine ต้องให้ผลเหมือน if-chain เดิม (compute_status / compute_status_neo ใน index.py)
+ไม่ต้องใช้ DB
+"""
+from itertools import product
+from types import SimpleNamespace
+
+import pytest
+
+from api import status_engine
+
+NEO = "บริษัท นีโอ แฟคทอรี่ จำกัด"
+
+
+# --- if-chain เดิมก่อนเปลี่ยนเป็นตาราง milestone (คัดลอกมาเป็นตัวอ้างอิง) ---
+def legacy_compute_status(ticket):
+    if ticket.complete_datetime:        return "จัดส่งแล้ว (POD)"
+    if ticket.end_unload_datetime:      return "ลงสินค้าเสร็จ"
+    if ticket.start_unload_datetime:    return "เริ่มลงสินค้า"
+    if ticket.desination_datetime:      return "ถึงปลายทาง"
+    if ticket.intransit_datetime:       return "เริ่มขนส่ง"
+    if ticket.end_recive_datetime:      return "ขึ้นสินค้าเสร็จ"
+    if ticket.start_recive_datetime:    return "เริ่มขึ้นสินค้า"
+    if ticket.origin_datetime:          return "ถึงต้นทาง"
+    if ticket.start_datetime:           return "รับงาน"
+    return "พร้อมรับงาน"
+
+
+def legacy_compute_status_neo(ticket):
+    if ticket.complete_datetime:        return "จัดส่งแล้ว (POD)"
+    if ticket.docs_returned_datetime:   return "ได้รับเอกสารคืน"
+    if ticket.end_unload_datetime:      return "ลงสินค้าเสร็จ"
+    if ticket.start_unload_datetime:    return "เริ่มลงสินค้า"
+    if ticket.docs_submitted_datetime:  return "ยื่นเอกสาร"
+    if ticket.desination_datetime:      return "ถึงปลายทาง"
+    if ticket.intransit_datetime:       return "เริ่มขนส่ง"
+    if ticket.end_recive_datetime:      return "ขึ้นสินค้าเสร็จ"
+    if ticket.start_recive_datetime:    return "เริ่มขึ้นสินค้า"
+    if ticket.origin_datetime:          return "ถึงต้นทาง"
+    if ticket.start_datetime:           return "รับงาน"
+    return "พร้อมรับงาน"
+
+
+FIELDS = [f for f, _ in status_engine.NEO_MILESTONES]
+# ไม่มีค่า (None), ค่าว่าง, มีค่า
+VALUES = (None, "", "2026-10-18T10:00:00")
+
+
+def _tickets():
+    for values in product(VALUES, repeat=len(FIELDS)):
+        yield dict(zip(FIELDS, values))
+
+
+@pytest.mark.parametrize("locat_recive, legacy", [
+    (None, legacy_compute_status),
+    ("บริษัทอื่น", legacy_compute_status),
+    (NEO, legacy_compute_status_neo),
+])
+def test_matches_legacy_if_chain(locat_recive, legacy):
+    for ticket in _tickets():
+        expected = legacy(SimpleNamespace(**ticket))
+        assert status_engine.compute_status(ticket, locat_recive) == expected, ticket
+
+
+def test_no_milestone_is_ready():
+    ticket = dict.fromkeys(FIELDS)
+    assert status_engine.compute_status(ticket) == status_engine.READY_STATUS
+    assert status_engine.compute_status(ticket, NEO) == status_engine.READY_STATUS
+
+
+def test_single_milestone_table():
+    evaluate = status_engine.compile_milestones([("start_datetime", "รับงาน")])
+    assert evaluate({"start_datetime": "x"}) == "รับงาน"
+    assert evaluate({"start_datetime": ""}) == status_engine.READY_STATUS